@@ -4,18 +4,27 @@ import sys
 
 HOST = 'localhost'
 PORT = 4300
+DELIMITER = b'\n'
 
 
-def main(name: str):
+def main(name: str, count: int = 1):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((HOST, PORT))
         print('Connected to {}:{}'.format(HOST, PORT))
-        s.sendall("Hi, I'm {}".format(name).encode())
-        data = s.recv(1024)
-        print('Received: {}'.format(data.decode()))
+        s.sendall(("Hi, I'm {}".format(name).encode() + DELIMITER) * count)
+        buffer = bytearray()
+        received = 0
+        while received < count:
+            data = s.recv(65536)
+            if not data:
+                break
+            buffer.extend(data)
+            received += data.count(DELIMITER)
+        for data in buffer.split(DELIMITER)[:count]:
+            print('Received: {}'.format(data.decode()))
         s.close()
         print('Connection closed')
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1)
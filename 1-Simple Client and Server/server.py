@@ -1,25 +1,130 @@
 '''Simple server program'''
+import selectors
 import socket
 
 HOST = '127.0.0.1'
 PORT = 4300
+BACKLOG = 1024
+DELIMITER = b'\n'
+MAX_MESSAGE = 4096
+RECV_SIZE = 65536
+MAX_PENDING = 1 << 20
+
+# The loop is single-threaded, so every connection receives into the same buffer
+RECV_BUFFER = bytearray(RECV_SIZE)
+
+
+def greet(data) -> bytes:
+    '''Answer a greeting'''
+    words = str(data, 'utf-8', 'replace').split()
+    if len(words) < 3:
+        return "Error: expected \"Hi, I'm <name>\"".encode()
+    return "Hello, {}".format(words[2]).encode()
+
+
+def handle_input(buffer: bytearray, out: bytearray) -> int:
+    '''Answer every complete message in the buffer and drop them from it'''
+
+    '''
+        Messages end with DELIMITER and may be split across reads or arrive many per read. They are greeted straight from slices of a memoryview over the buffer, and the consumed bytes are removed once per call rather than once per message. An incomplete message stays in the buffer for the next call. Returns the number of messages answered.
+    '''
+
+    start = 0
+    answered = 0
+    with memoryview(buffer) as view:
+        while True:
+            end = buffer.find(DELIMITER, start)
+            if end < 0:
+                break
+            out += greet(view[start:end])
+            out += DELIMITER
+            start = end + 1
+            answered += 1
+    del buffer[:start]
+    if len(buffer) > MAX_MESSAGE:
+        raise ValueError('Message longer than {} bytes'.format(MAX_MESSAGE))
+    return answered
+
+
+def accept(sel: selectors.BaseSelector, s: socket.socket) -> None:
+    '''Register a new client connection'''
+    conn, addr = s.accept()
+    conn.setblocking(False)
+    state = {'addr': addr, 'in': bytearray(), 'out': bytearray()}
+    sel.register(conn, selectors.EVENT_READ, state)
+    print('Accepted connection from {}'.format(addr))
+
+
+def close(sel: selectors.BaseSelector, conn: socket.socket, state: dict) -> None:
+    '''Forget a client connection'''
+    sel.unregister(conn)
+    conn.close()
+    print('Connection closed: {}'.format(state['addr']))
+
+
+def interest(out: bytearray) -> int:
+    '''Events to wait for given the pending output'''
+
+    '''
+        A client that sends faster than it reads would make its pending output grow without bound, so reading from it stops while more than MAX_PENDING bytes wait to be sent, and resumes once they drain.
+    '''
+
+    if not out:
+        return selectors.EVENT_READ
+    if len(out) > MAX_PENDING:
+        return selectors.EVENT_WRITE
+    return selectors.EVENT_READ | selectors.EVENT_WRITE
+
+
+def flush(sel: selectors.BaseSelector, conn: socket.socket, state: dict) -> None:
+    '''Send as much pending output as the socket takes, waiting for writability if some is left'''
+    out = state['out']
+    try:
+        sent = conn.send(out)
+    except BlockingIOError:
+        sent = 0
+    del out[:sent]
+    sel.modify(conn, interest(out), state)
+
+
+def serve(sel: selectors.BaseSelector, conn: socket.socket, state: dict, mask: int) -> None:
+    '''Handle a ready client connection'''
+    try:
+        if mask & selectors.EVENT_READ:
+            n = conn.recv_into(RECV_BUFFER)
+            if not n:
+                close(sel, conn, state)
+                return
+            with memoryview(RECV_BUFFER) as chunk:
+                state['in'] += chunk[:n]
+            handle_input(state['in'], state['out'])
+        if state['out']:
+            flush(sel, conn, state)
+    except (ConnectionError, ValueError) as e:
+        print('Dropping {}: {}'.format(state['addr'], e))
+        close(sel, conn, state)
 
 
 def main():
+    sel = selectors.DefaultSelector()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((HOST, PORT))
-        s.listen(1)
+        s.listen(BACKLOG)
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
         print('Listening on port {}'.format(PORT))
-        conn, addr = s.accept()
-        with conn:
-            print('Accepted connection from {}'.format(addr))
+        try:
             while True:
-                data = conn.recv(1024)
-                if not data:
-                    print('Connection closed')
-                    break
-                name = data.decode().split()[2]
-                conn.sendall("Hello, {}".format(name).encode())
+                for key, mask in sel.select():
+                    if key.fileobj is s:
+                        accept(sel, s)
+                    else:
+                        serve(sel, key.fileobj, key.data, mask)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sel.close()
 
 
 if __name__ == '__main__':
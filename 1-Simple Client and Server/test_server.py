@@ -0,0 +1,58 @@
+'''
+Testing the simple server
+'''
+#!/usr/bin/python3
+
+import pytest
+from server import greet
+from server import handle_input
+from server import MAX_MESSAGE
+
+
+class TestServer:
+    '''Testing the simple server'''
+
+    def test_greet(self):
+        '''Greet the name in the message'''
+        assert greet(b"Hi, I'm Ann") == b'Hello, Ann'
+        assert greet(memoryview(b"Hi, I'm Ann Lee")) == b'Hello, Ann'
+
+    def test_greet_malformed(self):
+        '''Answer a malformed greeting with an error'''
+        assert greet(b'Hello') == b'Error: expected "Hi, I\'m <name>"'
+        assert greet(b'') == b'Error: expected "Hi, I\'m <name>"'
+        assert greet(b"Hi, I'm \xffAnn") == 'Hello, �Ann'.encode()
+
+    def test_handle_input_split(self):
+        '''Wait for the rest of a message split across reads'''
+        buffer = bytearray(b"Hi, I")
+        out = bytearray()
+        assert handle_input(buffer, out) == 0
+        assert buffer == b"Hi, I" and out == b''
+        buffer += b"'m Ann\nHi, I'm"
+        assert handle_input(buffer, out) == 1
+        assert buffer == b"Hi, I'm" and out == b'Hello, Ann\n'
+        buffer += b' Bob\n'
+        assert handle_input(buffer, out) == 1
+        assert buffer == b'' and out == b'Hello, Ann\nHello, Bob\n'
+
+    def test_handle_input_many(self):
+        '''Answer several messages arriving in one read, in order'''
+        buffer = bytearray(b"Hi, I'm Ann\nbad\nHi, I'm Bob\n")
+        out = bytearray()
+        assert handle_input(buffer, out) == 3
+        assert buffer == b''
+        assert out == b'Hello, Ann\nError: expected "Hi, I\'m <name>"\nHello, Bob\n'
+
+    def test_handle_input_too_long(self):
+        '''Reject a message longer than MAX_MESSAGE without a delimiter'''
+        out = bytearray()
+        buffer = bytearray(b'x' * MAX_MESSAGE)
+        assert handle_input(buffer, out) == 0
+        buffer += b'x'
+        with pytest.raises(ValueError):
+            handle_input(buffer, out)
+        buffer = bytearray(b"Hi, I'm Ann\n" + b'x' * (MAX_MESSAGE + 1))
+        with pytest.raises(ValueError):
+            handle_input(buffer, out)
+        assert out == b'Hello, Ann\n'
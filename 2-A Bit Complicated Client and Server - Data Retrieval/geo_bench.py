@@ -0,0 +1,143 @@
+'''
+GEO load generator
+'''
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+from bisect import bisect
+from itertools import accumulate, count
+import random
+import time
+
+from geo_protocol import encode_frame, decode_frames, OP_GET, OP_ERROR
+from geo_server_tcp import load_dataset, FILE_NAME, HOST, PORT
+
+DISTRIBUTIONS = ('uniform', 'zipf', 'miss')
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def make_sampler(keys: list, distribution: str, rng: random.Random, zipf_s: float = 1.1, miss_ratio: float = 0.5):
+    '''Build a function returning the next key to look up'''
+
+    '''
+        uniform picks every key with the same probability. zipf picks the key of rank k with probability proportional to 1/k^s, so a few keys get most of the traffic. miss picks uniformly but replaces a miss_ratio share of the lookups with keys that are not in the dataset.
+    '''
+
+    if distribution == 'uniform':
+        return lambda: keys[rng.randrange(len(keys))]
+    if distribution == 'zipf':
+        weights = list(accumulate(1 / rank ** zipf_s for rank in range(1, len(keys) + 1)))
+        total = weights[-1]
+        return lambda: keys[min(bisect(weights, rng.random() * total), len(keys) - 1)]
+    if distribution == 'miss':
+        return lambda: 'Missing {}'.format(rng.randrange(1 << 30)) if rng.random() < miss_ratio else keys[rng.randrange(len(keys))]
+    raise ValueError('Unknown distribution {}'.format(distribution))
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    '''Nearest-rank percentile of a sorted list'''
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def histogram(latencies: list) -> list:
+    '''Count latencies in power-of-two microsecond buckets, as (upper bound in us, count) pairs'''
+    buckets = dict()
+    for latency in latencies:
+        bound = 1
+        while bound < latency * 1e6:
+            bound <<= 1
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return sorted(buckets.items())
+
+
+async def run_connection(host: str, port: int, sample, pipeline: int, deadline: float, latencies: list, errors: list) -> None:
+    '''Keep pipeline lookups in flight on one connection until the deadline'''
+    reader, writer = await asyncio.open_connection(host, port)
+    req_ids = count(1)
+    sent = dict()
+
+    def send(n: int) -> None:
+        frames = []
+        now = time.perf_counter()
+        for _ in range(n):
+            req_id = next(req_ids)
+            sent[req_id] = now
+            frames.append(encode_frame(req_id, OP_GET, sample().encode('utf-8')))
+        writer.write(b''.join(frames))
+
+    buffer = bytearray()
+    send(pipeline)
+    try:
+        while sent:
+            data = await reader.read(65536)
+            if not data:
+                errors.append('Connection closed by the server')
+                break
+            buffer.extend(data)
+            now = time.perf_counter()
+            frames = decode_frames(buffer)
+            for req_id, op, _ in frames:
+                latencies.append(now - sent.pop(req_id))
+                if op == OP_ERROR:
+                    errors.append('Error response')
+            if now < deadline and frames:
+                send(len(frames))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def benchmark(host: str, port: int, sample, connections: int, pipeline: int, duration: float) -> tuple:
+    '''Drive the server from many connections and collect the latencies'''
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + duration
+    results = await asyncio.gather(*[run_connection(host, port, sample, pipeline, deadline, latencies, errors)
+                                     for _ in range(connections)], return_exceptions=True)
+    elapsed_time = time.perf_counter() - start
+    errors.extend(str(r) for r in results if isinstance(r, Exception))
+    return latencies, errors, elapsed_time
+
+
+def report(latencies: list, errors: list, elapsed_time: float) -> None:
+    '''Print throughput, latency percentiles and the latency histogram'''
+    latencies.sort()
+    print('Requests: {} in {:.2f} sec, {:.0f} req/s, {} errors'.format(
+        len(latencies), elapsed_time, len(latencies) / elapsed_time, len(errors)))
+    if not latencies:
+        return
+    print('Latency: ' + ', '.join('p{:g} {:.3f} ms'.format(pct, percentile(latencies, pct) * 1e3)
+                                  for pct in PERCENTILES + (100,)))
+    for bound, n in histogram(latencies):
+        print('{:>10} us {:>10} {}'.format('<= {}'.format(bound), n, '#' * max(1, round(50 * n / len(latencies)))))
+
+
+def main():
+    '''Main function'''
+    parser = argparse.ArgumentParser(description='GEO load generator')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--connections', type=int, default=100, help='concurrent connections')
+    parser.add_argument('--pipeline', type=int, default=10, help='lookups in flight per connection')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='zipf exponent')
+    parser.add_argument('--miss-ratio', type=float, default=0.5, help='share of misses for the miss distribution')
+    parser.add_argument('--seed', type=int, default=430)
+    parser.add_argument('--file', default=FILE_NAME, help='dataset to draw the keys from')
+    args = parser.parse_args()
+
+    keys = list(load_dataset(args.file)['world'])
+    sample = make_sampler(keys, args.distribution, random.Random(args.seed), args.zipf_s, args.miss_ratio)
+    print('Running {} connections x {} in flight for {} sec, {} keys'.format(
+        args.connections, args.pipeline, args.duration, args.distribution))
+    report(*asyncio.run(benchmark(args.host, args.port, sample, args.connections, args.pipeline, args.duration)))
+
+
+if __name__ == "__main__":
+    main()
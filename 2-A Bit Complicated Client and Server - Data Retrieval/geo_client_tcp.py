@@ -3,25 +3,81 @@ GEO TCP Client
 '''
 #!/usr/bin/env python3
 
+from itertools import count
 from socket import socket, AF_INET, SOCK_STREAM
 
+from geo_protocol import encode_frame, recv_frames, OP_GET, OP_MGET, OP_PREFIX, OP_FUZZY, OP_ERROR, NOT_FOUND, SEPARATOR
+
 HOST = 'localhost'
 PORT = 4300
 
+REQUEST_IDS = count(1)
+
+
+def send_requests(s: socket, op: int, payloads: list) -> list:
+    '''Pipeline requests on the connection and return their ids'''
+    req_ids = []
+    frames = []
+    for payload in payloads:
+        req_id = next(REQUEST_IDS) & 0xFFFFFFFF
+        req_ids.append(req_id)
+        frames.append(encode_frame(req_id, op, payload.encode('utf-8')))
+    s.sendall(b''.join(frames))
+    return req_ids
+
+
+def recv_responses(s: socket, buffer: bytearray, req_ids: list) -> list:
+    '''Wait for the responses to the given requests and return them in request order'''
+    pending = set(req_ids)
+    responses = {}
+    while pending:
+        for req_id, op, payload in recv_frames(s, buffer):
+            if req_id not in pending:
+                continue
+            if op == OP_ERROR:
+                raise ValueError(payload.decode())
+            responses[req_id] = payload.decode()
+            pending.discard(req_id)
+    return [responses[req_id] for req_id in req_ids]
+
+
+def lookup_many(s: socket, buffer: bytearray, countries: list) -> list:
+    '''Look up many countries without waiting for each reply'''
+    return recv_responses(s, buffer, send_requests(s, OP_GET, countries))
+
+
+def mget(s: socket, buffer: bytearray, countries: list) -> list:
+    '''Look up many countries with a single batch request'''
+    if not countries:
+        return []
+    if any(SEPARATOR in country for country in countries):
+        raise ValueError('Country names cannot contain line breaks')
+    response = recv_responses(s, buffer, send_requests(s, OP_MGET, [SEPARATOR.join(countries)]))[0]
+    return response.split(SEPARATOR)
+
+
+def search(s: socket, buffer: bytearray, text: str, fuzzy: bool = False) -> list:
+    '''Find "Country - Capital" entries by prefix, or by similarity if fuzzy is set'''
+    response = recv_responses(s, buffer, send_requests(s, OP_FUZZY if fuzzy else OP_PREFIX, [text]))[0]
+    return [] if response == NOT_FOUND else response.split(SEPARATOR)
+
 
 def client():
     '''Main client loop'''
     with socket(AF_INET, SOCK_STREAM) as s:
         s.connect((HOST, PORT))
+        buffer = bytearray()
         print('>You are connected to {}:{}'.format(HOST, PORT))
-        country = input('>Enter a country or BYE to quit\n')
+        country = input('>Enter a country (or several separated by ;) or BYE to quit\n')
         while country.upper() != "BYE":
-            s.sendall(country.encode())
-            data = s.recv(1024)
-            if data.decode() == "NOT FOUND":
-                print("-There is no such country")                
-            else:
-                print('+{}'.format(data.decode()))
+            countries = [c.strip() for c in country.split(';')]
+            for name, capital in zip(countries, mget(s, buffer, countries)):
+                if capital == NOT_FOUND:
+                    print("-There is no such country")
+                    for match in search(s, buffer, name, fuzzy=True):
+                        print('?Did you mean {}'.format(match))
+                else:
+                    print('+{}'.format(capital))
             country = input('>Enter another country to try again or BYE to quit\n')
         s.close()
         print('Connection ')
@@ -0,0 +1,129 @@
+'''
+GEO compact dataset
+'''
+#!/usr/bin/env python3
+
+import mmap
+import os
+import struct
+
+'''
+    A compact dataset is a precompiled, read-only file that is memory-mapped and binary-searched instead of being parsed into a dict, so opening it is instant and the data stays in the page cache rather than in the process heap.
+
+        47 45 4f 31 00 00 00 02 | entry 0 | entry 1 | Albania Tirana Peru Lima
+        |---------| |---------|
+        | magic   | | count   |
+
+    Each entry is 12 bytes: the file offset of the key (8 bytes), the key length and the value length (2 bytes each). The value follows its key directly. Entries are sorted by the UTF-8 bytes of the key.
+'''
+
+MAGIC = b'GEO1'
+HEADER = struct.Struct('>4sI')
+ENTRY = struct.Struct('>QHH')
+
+
+def write_compact(world: dict, filename: str) -> None:
+    '''Compile a world dict into a compact dataset file'''
+    items = sorted((key.encode('utf-8'), value.encode('utf-8')) for key, value in world.items())
+    data_start = HEADER.size + ENTRY.size * len(items)
+
+    entries = bytearray()
+    offset = data_start
+    for key, value in items:
+        entries.extend(ENTRY.pack(offset, len(key), len(value)))
+        offset += len(key) + len(value)
+
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(items)))
+        f.write(entries)
+        for key, value in items:
+            f.write(key)
+            f.write(value)
+    os.replace(tmp_name, filename)
+
+
+def is_compact(filename: str) -> bool:
+    '''Check whether a file is a compact dataset'''
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class CompactWorld:
+    '''Read-only mapping over a memory-mapped compact dataset'''
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('Not a compact dataset: {}'.format(filename))
+        if len(self._map) < HEADER.size + ENTRY.size * self._count:
+            self._map.close()
+            raise ValueError('Truncated compact dataset: {}'.format(filename))
+
+    def _entry(self, i: int) -> tuple:
+        return ENTRY.unpack_from(self._map, HEADER.size + ENTRY.size * i)
+
+    def _key(self, i: int) -> bytes:
+        offset, key_len, _ = self._entry(i)
+        return self._map[offset:offset + key_len]
+
+    def _value(self, i: int) -> str:
+        offset, key_len, value_len = self._entry(i)
+        return self._map[offset + key_len:offset + key_len + value_len].decode('utf-8')
+
+    def _bisect(self, key: bytes) -> int:
+        '''Position of the first key not less than the given one'''
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, country: str) -> int:
+        key = country.encode('utf-8')
+        i = self._bisect(key)
+        if i < self._count and self._key(i) == key:
+            return i
+        return -1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, country: str) -> bool:
+        return self._find(country) >= 0
+
+    def __getitem__(self, country: str) -> str:
+        i = self._find(country)
+        if i < 0:
+            raise KeyError(country)
+        return self._value(i)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._key(i).decode('utf-8')
+
+    def get(self, country: str, default: str = None) -> str:
+        i = self._find(country)
+        return self._value(i) if i >= 0 else default
+
+    def keys_with_prefix(self, prefix: str, limit: int) -> list:
+        '''Up to limit keys starting with a prefix (case-sensitive), in order'''
+        prefix = prefix.encode('utf-8')
+        keys = []
+        i = self._bisect(prefix)
+        while i < self._count and len(keys) < limit:
+            key = self._key(i)
+            if not key.startswith(prefix):
+                break
+            keys.append(key.decode('utf-8'))
+            i += 1
+        return keys
+
+    def close(self) -> None:
+        self._map.close()
@@ -0,0 +1,115 @@
+'''
+GEO search index
+'''
+#!/usr/bin/env python3
+
+import unicodedata
+
+'''
+    The index is built once per dataset and has three parts:
+
+        names       normalized name -> list of original names
+        trie        prefix trie over normalized names, END marks the names ending at a node
+        trigrams    trigram -> set of original names containing it
+
+    Names are normalized by removing accents, case folding and replacing punctuation with spaces, so "cote d'ivoire" and "Côte d’Ivoire" are the same key.
+'''
+
+END = '$'
+PREFIX_LIMIT = 10
+FUZZY_LIMIT = 5
+FUZZY_MIN_SCORE = 0.5
+
+
+def normalize(name: str) -> str:
+    '''Normalize a name for matching'''
+    decomposed = unicodedata.normalize('NFKD', name)
+    chars = [c if c.isalnum() else ' ' for c in decomposed if not unicodedata.combining(c)]
+    return ' '.join(''.join(chars).casefold().split())
+
+
+def trigrams(text: str) -> set:
+    '''Split a normalized name into trigrams, padded at the word edges'''
+    padded = '  {} '.format(text)
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+def build_index(world: dict) -> dict:
+    '''Build the search index over the names of a world dict'''
+    names = dict()
+    trie = dict()
+    grams = dict()
+    for name in world:
+        key = normalize(name)
+        names.setdefault(key, []).append(name)
+
+        node = trie
+        for c in key:
+            node = node.setdefault(c, dict())
+        node.setdefault(END, []).append(name)
+
+        for gram in trigrams(key):
+            grams.setdefault(gram, set()).add(name)
+
+    return {'names': names, 'trie': trie, 'trigrams': grams}
+
+
+def find(index: dict, query: str) -> str:
+    '''Find the original name matching a query after normalization, or None'''
+    matches = index['names'].get(normalize(query))
+    return matches[0] if matches else None
+
+
+def prefix_search(index: dict, prefix: str, limit: int = PREFIX_LIMIT) -> list:
+    '''Find up to limit names starting with a prefix, in alphabetical order'''
+    node = index['trie']
+    for c in normalize(prefix):
+        if c not in node:
+            return []
+        node = node[c]
+
+    results = []
+    stack = [node]
+    while stack and len(results) < limit:
+        node = stack.pop()
+        results.extend(node.get(END, []))
+        stack.extend(node[c] for c in sorted((c for c in node if c != END), reverse=True))
+    return results[:limit]
+
+
+def edit_distance(a: str, b: str) -> int:
+    '''Levenshtein distance between two strings'''
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def fuzzy_search(index: dict, query: str, limit: int = FUZZY_LIMIT) -> list:
+    '''Find up to limit names similar to a possibly misspelled query, best first'''
+
+    '''
+        Candidates are the names sharing trigrams with the query, so only a handful of entries are compared instead of the whole dataset. A candidate's score is the share of the query trigrams it contains; ties are broken by edit distance.
+    '''
+
+    key = normalize(query)
+    if not key:
+        return []
+    query_grams = trigrams(key)
+    shared = dict()
+    for gram in query_grams:
+        for name in index['trigrams'].get(gram, ()):
+            shared[name] = shared.get(name, 0) + 1
+
+    candidates = []
+    for name, count in shared.items():
+        score = count / len(query_grams)
+        if score >= FUZZY_MIN_SCORE:
+            candidates.append((-score, edit_distance(key, normalize(name)), name))
+    candidates.sort()
+    return [name for _, _, name in candidates[:limit]]
@@ -0,0 +1,76 @@
+'''
+GEO wire protocol
+'''
+#!/usr/bin/env python3
+
+import struct
+
+'''
+    Every message is a frame:
+
+        00 00 00 0c 00 00 00 01 01 41 6c 62 61 6e 69 61
+        |---------| |---------| || |------------------|
+        | length  | | req id  | op | payload          |
+
+    length counts the bytes after the length field (request id, opcode and payload). The response to a request carries the same request id and opcode, so a client may send many requests without waiting and match the replies afterwards.
+
+    OP_GET carries one country name and is answered with its capital or NOT FOUND. OP_MGET carries country names separated by SEPARATOR and is answered with the capitals (or NOT FOUND markers) in the same order, separated the same way.
+
+    OP_PREFIX and OP_FUZZY carry a search string and are answered with up to a few "Country - Capital" entries separated by SEPARATOR, or NOT FOUND. Matching ignores case, accents and punctuation; OP_FUZZY also tolerates typos.
+'''
+
+HEADER = struct.Struct('>IIB')
+LENGTH = struct.Struct('>I')
+MAX_FRAME = 1 << 20
+
+OP_GET = 1
+OP_MGET = 2
+OP_PREFIX = 3
+OP_FUZZY = 4
+OP_ERROR = 0xFF
+
+NOT_FOUND = 'NOT FOUND'
+SEPARATOR = '\n'
+
+
+def encode_frame(req_id: int, op: int, payload: bytes) -> bytes:
+    '''Build a single frame'''
+    return HEADER.pack(len(payload) + HEADER.size - LENGTH.size, req_id, op) + payload
+
+
+def decode_frames(buffer: bytearray) -> list:
+    '''Consume all complete frames from the buffer'''
+
+    '''
+        decode_frames returns a list of (req_id, op, payload) tuples and removes the parsed bytes from the buffer. An incomplete frame at the end stays in the buffer until more data arrives.
+    '''
+
+    frames = []
+    view = memoryview(buffer)
+    offset = 0
+    try:
+        while len(buffer) - offset >= HEADER.size:
+            length, req_id, op = HEADER.unpack_from(buffer, offset)
+            if length > MAX_FRAME or length < HEADER.size - LENGTH.size:
+                raise ValueError('Invalid frame length: {}'.format(length))
+            end = offset + LENGTH.size + length
+            if end > len(buffer):
+                break
+            frames.append((req_id, op, bytes(view[offset + HEADER.size:end])))
+            offset = end
+    finally:
+        view.release()
+    del buffer[:offset]
+    return frames
+
+
+def recv_frames(sock, buffer: bytearray, bufsize: int = 65536) -> list:
+    '''Block until at least one complete frame arrives on the socket'''
+    while True:
+        data = sock.recv(bufsize)
+        if not data:
+            raise ConnectionError('Connection closed by the server')
+        buffer.extend(data)
+        frames = decode_frames(buffer)
+        if frames:
+            return frames
@@ -3,12 +3,25 @@ GEO TCP Server
 '''
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+from multiprocessing.sharedctypes import RawArray
+import os
+import signal
 from socket import socket, AF_INET, SOCK_STREAM
 import time
 
+from geo_compact import CompactWorld, is_compact, write_compact
+from geo_index import build_index, find, prefix_search, fuzzy_search, PREFIX_LIMIT
+from geo_protocol import encode_frame, decode_frames, OP_GET, OP_MGET, OP_PREFIX, OP_FUZZY, OP_ERROR, NOT_FOUND, SEPARATOR
+
 FILE_NAME = 'geo_world.txt'
 HOST = 'localhost'
 PORT = 4300
+BACKLOG = 4096
+STATS_INTERVAL = 10
+RELOAD_INTERVAL = 2
+STAT_FIELDS = ('connections', 'active', 'requests', 'reloads')
 
 
 def read_file(filename: str) -> dict:
@@ -21,6 +34,8 @@ def read_file(filename: str) -> dict:
     with open(filename, 'r') as f:
         for line in f:
             line = line.strip()
+            if not line:
+                continue
             line = line.split('-')
             world[line[0].strip()] = line[1].strip()
     elapsed_time = time.process_time() - t
@@ -30,7 +45,85 @@ def read_file(filename: str) -> dict:
     return world
 
 
-def server(world: dict) -> None:
+def load_dataset(filename: str) -> dict:
+    '''Read the file and build the search index over it'''
+
+    '''
+        A compact dataset (see geo_compact.py) is memory-mapped instead, without an index: lookups are exact and prefix searches are case-sensitive.
+    '''
+
+    if is_compact(filename):
+        t = time.perf_counter()
+        world = CompactWorld(filename)
+        elapsed_time = time.perf_counter() - t
+        print(time.strftime('%H:%M:%S'), "Mapped {} records in {:.5f}".format(len(world), elapsed_time), "sec")
+        return {'world': world, 'index': None}
+
+    world = read_file(filename)
+
+    t = time.process_time()
+    index = build_index(world)
+    elapsed_time = time.process_time() - t
+
+    print(time.strftime('%H:%M:%S'), "Indexed {} records in {:.5f}".format(len(world), elapsed_time), "sec")
+
+    return {'world': world, 'index': index}
+
+
+def lookup(dataset: dict, country: str) -> str:
+    '''Look up the capital of a country, ignoring case and accents if there is no exact match'''
+    world = dataset['world']
+    capital = world.get(country)
+    if capital is not None:
+        return capital
+    if dataset['index'] is None:
+        return NOT_FOUND
+    name = find(dataset['index'], country)
+    return world[name] if name is not None else NOT_FOUND
+
+
+def search(dataset: dict, op: int, text: str) -> list:
+    '''Find names by prefix or by similarity'''
+    if dataset['index'] is None:
+        return dataset['world'].keys_with_prefix(text, PREFIX_LIMIT) if op == OP_PREFIX else []
+    if op == OP_PREFIX:
+        return prefix_search(dataset['index'], text)
+    return fuzzy_search(dataset['index'], text)
+
+
+def format_matches(dataset: dict, names: list) -> str:
+    '''Format search results as "Country - Capital" entries'''
+    if not names:
+        return NOT_FOUND
+    return SEPARATOR.join(['{} - {}'.format(name, dataset['world'][name]) for name in names])
+
+
+def handle_request(dataset: dict, op: int, payload: bytes) -> tuple:
+    '''Answer a single request, returning the response opcode and payload'''
+    if op not in (OP_GET, OP_MGET, OP_PREFIX, OP_FUZZY):
+        return OP_ERROR, 'Unknown opcode {}'.format(op).encode('utf-8')
+    try:
+        text = payload.decode()
+    except UnicodeDecodeError:
+        return OP_ERROR, b'Invalid UTF-8 in request'
+    if op == OP_GET:
+        return op, lookup(dataset, text).encode('utf-8')
+    if op == OP_MGET:
+        countries = text.split(SEPARATOR)
+        return op, SEPARATOR.join([lookup(dataset, country) for country in countries]).encode('utf-8')
+    return op, format_matches(dataset, search(dataset, op, text)).encode('utf-8')
+
+
+def handle_frames(dataset: dict, frames: list) -> bytes:
+    '''Answer a batch of requests with one contiguous block of response frames'''
+    responses = []
+    for req_id, op, payload in frames:
+        resp_op, resp_payload = handle_request(dataset, op, payload)
+        responses.append(encode_frame(req_id, resp_op, resp_payload))
+    return b''.join(responses)
+
+
+def server(dataset: dict) -> None:
     '''Main server loop'''
     with socket(AF_INET, SOCK_STREAM) as s:
         s.bind((HOST, PORT))
@@ -39,23 +132,249 @@ def server(world: dict) -> None:
         conn, addr = s.accept()
         with conn:
             print(time.strftime('%H:%M:%S'), 'Connected: {}'.format(addr[0]))
+            buffer = bytearray()
             while True:
-                data = conn.recv(1024)
+                data = conn.recv(65536)
                 if not data:
                     print(time.strftime('%H:%M:%S'), 'Disconnected: {}'.format(addr[0]))
                     break
-                country = data.decode()
-                print(time.strftime('%H:%M:%S'), 'User Query: {}'.format(country))
-                if country in world:
-                    conn.sendall(world[country].encode('utf-8'))
-                else:
-                    conn.sendall("NOT FOUND".encode('utf-8'))
+                buffer.extend(data)
+                try:
+                    frames = decode_frames(buffer)
+                except ValueError as ve:
+                    print(time.strftime('%H:%M:%S'), 'Dropping {}: {}'.format(addr[0], ve))
+                    break
+                for _, _, payload in frames:
+                    print(time.strftime('%H:%M:%S'), 'User Query: {}'.format(', '.join(payload.decode(errors='replace').split(SEPARATOR))))
+                conn.sendall(handle_frames(dataset, frames))
+
+
+def new_stats() -> dict:
+    '''Create the connection and request counters'''
+    return {field: 0 for field in STAT_FIELDS}
+
+
+def format_stats(stats: dict) -> str:
+    '''Format the counters for logging'''
+    return 'Connections: {connections} total, {active} active, Requests: {requests}, Reloads: {reloads}'.format(**stats)
+
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, state: dict, stats: dict) -> None:
+    '''Serve lookups on one persistent connection'''
+
+    '''
+        state['dataset'] is read once per batch, so every batch is answered from a single complete dataset even if a reload swaps it in the meantime.
+    '''
+
+    stats['connections'] += 1
+    stats['active'] += 1
+    buffer = bytearray()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            buffer.extend(data)
+            frames = decode_frames(buffer)
+            if not frames:
+                continue
+            stats['requests'] += len(frames)
+            writer.write(handle_frames(state['dataset'], frames))
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        stats['active'] -= 1
+        writer.close()
+
+
+async def report_stats(stats: dict, interval: float = STATS_INTERVAL) -> None:
+    '''Periodically print the counters'''
+    while True:
+        await asyncio.sleep(interval)
+        print(time.strftime('%H:%M:%S'), format_stats(stats))
+
+
+def publish_stats(stats: dict, shared: RawArray, slot: int) -> None:
+    '''Copy a worker's counters into its slot of the shared array'''
+    base = slot * len(STAT_FIELDS)
+    for i, field in enumerate(STAT_FIELDS):
+        shared[base + i] = stats[field]
+
+
+def read_stats(shared: RawArray, slot: int) -> dict:
+    '''Read a worker's counters from the shared array'''
+    base = slot * len(STAT_FIELDS)
+    return {field: shared[base + i] for i, field in enumerate(STAT_FIELDS)}
+
+
+async def share_stats(stats: dict, shared: RawArray, slot: int, interval: float = 1) -> None:
+    '''Periodically publish the counters for the parent process'''
+    while True:
+        publish_stats(stats, shared, slot)
+        await asyncio.sleep(interval)
+
+
+def file_signature(filename: str) -> tuple:
+    '''Identify the current version of a file, None if it is missing'''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+async def watch_dataset(filename: str, state: dict, stats: dict, interval: float = RELOAD_INTERVAL) -> None:
+    '''Reload the dataset in the background whenever the file changes'''
+
+    '''
+        The new dataset is built in a worker thread while the old one keeps serving, then swapped in with a single assignment. A file that fails to load (e.g. caught in the middle of a write) keeps the old dataset in service until the file changes again.
+    '''
+
+    loop = asyncio.get_running_loop()
+    loaded = file_signature(filename)
+    while True:
+        await asyncio.sleep(interval)
+        signature = file_signature(filename)
+        if signature == loaded:
+            continue
+        loaded = signature
+        if signature is None:
+            print(time.strftime('%H:%M:%S'), 'Reload failed: {} is missing'.format(filename))
+            continue
+        try:
+            t = time.perf_counter()
+            dataset = await loop.run_in_executor(None, load_dataset, filename)
+            if file_signature(filename) != signature:
+                continue
+        except (OSError, ValueError, IndexError) as e:
+            print(time.strftime('%H:%M:%S'), 'Reload failed: {}'.format(e))
+            continue
+        elapsed_time = time.perf_counter() - t
+        previous = len(state['dataset']['world'])
+        state['dataset'] = dataset
+        stats['reloads'] += 1
+        print(time.strftime('%H:%M:%S'), 'Reloaded {} records ({} before) in {:.5f} sec'.format(
+            len(dataset['world']), previous, elapsed_time))
+
+
+async def serve_async(state: dict, stats: dict, host: str = HOST, port: int = PORT, filename: str = None,
+                      shared: RawArray = None, slot: int = 0) -> None:
+    '''Asyncio server loop accepting many concurrent clients'''
+
+    '''
+        With a shared array the server runs as one of several workers: it binds with SO_REUSEPORT so the kernel spreads connections across the workers, and it publishes its counters into its slot instead of printing them. SIGTERM from the parent closes the server, so the final counters are published before the worker exits. Once bound, the server is kept in state['server'], so a caller that passed port 0 can read the port it got and close the server.
+    '''
+
+    async def on_connect(reader, writer):
+        await handle_client(reader, writer, state, stats)
+
+    worker = shared is not None
+    srv = await asyncio.start_server(on_connect, host, port, backlog=BACKLOG, reuse_port=worker)
+    state['server'] = srv
+    if worker:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, srv.close)
+        tasks = [asyncio.create_task(share_stats(stats, shared, slot))]
+    else:
+        print(time.strftime('%H:%M:%S'), 'Listening on {}:{} (asyncio)'.format(host, srv.sockets[0].getsockname()[1]))
+        tasks = [asyncio.create_task(report_stats(stats))]
+    if filename is not None:
+        tasks.append(asyncio.create_task(watch_dataset(filename, state, stats)))
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if worker:
+            publish_stats(stats, shared, slot)
+        else:
+            print(time.strftime('%H:%M:%S'), format_stats(stats))
+
+
+def serve_workers(dataset: dict, workers: int, host: str = HOST, port: int = PORT, filename: str = None) -> None:
+    '''Pre-fork worker processes sharing one port and one dataset'''
+
+    '''
+        The dataset is loaded once before forking, so the workers share its memory (copy-on-write, or the page cache for a compact dataset). Each worker runs its own asyncio server on the same port with SO_REUSEPORT. The parent only collects and prints the per-worker and total counters. SIGTERM stops the parent like Ctrl-C: it stops the workers and prints their final counters.
+    '''
+
+    shared = RawArray('q', workers * len(STAT_FIELDS))
+    pids = dict()
+    for slot in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                asyncio.run(serve_async({'dataset': dataset}, new_stats(), host, port, filename, shared, slot))
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                pass
+            finally:
+                os._exit(0)
+        pids[pid] = slot
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    print(time.strftime('%H:%M:%S'), 'Listening on {}:{} ({} workers)'.format(host, port, workers))
+    try:
+        while pids:
+            time.sleep(STATS_INTERVAL)
+            while pids:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                print(time.strftime('%H:%M:%S'), 'Worker {} exited'.format(pids.pop(pid)))
+            report_workers(shared, workers)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        report_workers(shared, workers)
+
+
+def report_workers(shared: RawArray, workers: int) -> None:
+    '''Print the counters of every worker and their totals'''
+    total = new_stats()
+    for slot in range(workers):
+        stats = read_stats(shared, slot)
+        print(time.strftime('%H:%M:%S'), 'Worker {}: {}'.format(slot, format_stats(stats)))
+        for field in STAT_FIELDS:
+            total[field] += stats[field]
+    print(time.strftime('%H:%M:%S'), 'Total: {}'.format(format_stats(total)))
 
 
 def main():
     '''Main function'''
-    world = read_file(FILE_NAME)
-    server(world)
+    parser = argparse.ArgumentParser(description='GEO TCP Server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve many concurrent clients with asyncio')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run this many asyncio worker processes on the same port')
+    parser.add_argument('--file', default=FILE_NAME,
+                        help='territories and capitals file (default: {})'.format(FILE_NAME))
+    parser.add_argument('--compile', metavar='OUTPUT',
+                        help='write the file as a compact memory-mapped dataset and exit')
+    parser.add_argument('--no-reload', dest='reload', action='store_false',
+                        help='do not reload the file when it changes (asyncio and worker modes)')
+    args = parser.parse_args()
+
+    if args.compile:
+        write_compact(read_file(args.file), args.compile)
+        print(time.strftime('%H:%M:%S'), 'Compiled {} into {}'.format(args.file, args.compile))
+        return
+
+    dataset = load_dataset(args.file)
+    if args.workers > 0:
+        serve_workers(dataset, args.workers, filename=args.file if args.reload else None)
+    elif args.use_async:
+        try:
+            asyncio.run(serve_async({'dataset': dataset}, new_stats(),
+                                    filename=args.file if args.reload else None))
+        except KeyboardInterrupt:
+            pass
+    else:
+        server(dataset)
 
 
 if __name__ == "__main__":
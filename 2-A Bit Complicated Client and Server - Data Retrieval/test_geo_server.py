@@ -0,0 +1,265 @@
+'''
+Testing the GEO server
+'''
+#!/usr/bin/python3
+
+
+import asyncio
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+import pytest
+from geo_bench import make_sampler
+from geo_bench import percentile
+from geo_bench import histogram
+from geo_protocol import encode_frame
+from geo_protocol import decode_frames
+from geo_protocol import OP_GET, OP_MGET, OP_PREFIX, OP_FUZZY, OP_ERROR
+from geo_index import normalize
+from geo_index import edit_distance
+from geo_index import prefix_search
+from geo_index import fuzzy_search
+from geo_compact import write_compact
+from geo_compact import CompactWorld
+from geo_client_tcp import mget
+from geo_client_tcp import lookup_many
+from geo_server_tcp import load_dataset
+from geo_server_tcp import lookup
+from geo_server_tcp import new_stats
+from geo_server_tcp import watch_dataset
+from geo_server_tcp import serve_async
+from geo_server_tcp import handle_frames
+from geo_server_tcp import publish_stats
+from geo_server_tcp import read_stats
+from geo_server_tcp import report_workers
+from geo_server_tcp import STAT_FIELDS
+from geo_server_tcp import FILE_NAME
+from multiprocessing.sharedctypes import RawArray
+
+
+class TestGeoServer:
+    '''Testing GEO server'''
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        '''Setting up'''
+        self.dataset = load_dataset(FILE_NAME)
+
+    def test_encode_frame(self):
+        '''Encode a frame'''
+        assert encode_frame(1, OP_GET, b'Albania') == b'\x00\x00\x00\x0c\x00\x00\x00\x01\x01Albania'
+
+    def test_decode_frames_partial(self):
+        '''Keep incomplete frames in the buffer'''
+        frame = encode_frame(7, OP_GET, b'Albania')
+        buffer = bytearray(frame[:5])
+        assert decode_frames(buffer) == []
+        assert buffer == frame[:5]
+        buffer.extend(frame[5:])
+        assert decode_frames(buffer) == [(7, OP_GET, b'Albania')]
+        assert buffer == b''
+
+    def test_decode_frames_coalesced(self):
+        '''Split coalesced frames'''
+        buffer = bytearray(encode_frame(1, OP_GET, b'Albania') + encode_frame(2, OP_GET, b'Peru') + b'\x00\x00')
+        assert decode_frames(buffer) == [(1, OP_GET, b'Albania'), (2, OP_GET, b'Peru')]
+        assert buffer == b'\x00\x00'
+
+    def test_decode_frames_invalid(self):
+        '''Reject oversized frames'''
+        with pytest.raises(ValueError):
+            decode_frames(bytearray(b'\xff\xff\xff\xff\x00\x00\x00\x01\x01'))
+
+    def test_handle_frames(self):
+        '''Answer a batch of pipelined requests'''
+        frames = [(1, OP_GET, b'Albania'), (2, OP_GET, b'Atlantis'), (3, 42, b'')]
+        assert handle_frames(self.dataset, frames) == \
+            encode_frame(1, OP_GET, b'Tirana') + \
+            encode_frame(2, OP_GET, b'NOT FOUND') + \
+            encode_frame(3, OP_ERROR, b'Unknown opcode 42')
+
+    def test_handle_frames_invalid_utf8(self):
+        '''Reply with an error to a request that is not valid UTF-8'''
+        frames = [(1, OP_GET, b'Alb\xff'), (2, OP_GET, b'Peru')]
+        assert handle_frames(self.dataset, frames) == \
+            encode_frame(1, OP_ERROR, b'Invalid UTF-8 in request') + encode_frame(2, OP_GET, b'Lima')
+
+    def test_handle_frames_mget(self):
+        '''Answer a batch lookup in one response'''
+        frames = [(9, OP_MGET, b'Albania\nAtlantis\nPeru')]
+        assert handle_frames(self.dataset, frames) == encode_frame(9, OP_MGET, b'Tirana\nNOT FOUND\nLima')
+
+    def test_mget_empty(self):
+        '''Look up no countries without a round trip'''
+        assert mget(None, bytearray(), []) == []
+
+    def test_normalize(self):
+        '''Normalize names'''
+        assert normalize("  Côte d'Ivoire ") == 'cote d ivoire'
+        assert normalize('UNITED   States') == 'united states'
+
+    def test_edit_distance(self):
+        '''Count edits between two strings'''
+        assert edit_distance('albnia', 'albania') == 1
+        assert edit_distance('kitten', 'sitting') == 3
+        assert edit_distance('', 'peru') == 4
+
+    def test_prefix_search(self):
+        '''Search names by prefix'''
+        index = self.dataset['index']
+        assert prefix_search(index, 'united s') == ['United States', 'United States Virgin Islands']
+        assert prefix_search(index, 'a', limit=2) == ['Abkhazia', 'Afghanistan']
+        assert prefix_search(index, 'xyz') == []
+
+    def test_fuzzy_search(self):
+        '''Search names tolerating typos'''
+        index = self.dataset['index']
+        assert fuzzy_search(index, 'Albnia')[0] == 'Albania'
+        assert set(fuzzy_search(index, 'Congo')[:2]) == {'Republic of the Congo', 'Democratic Republic of the Congo'}
+        assert fuzzy_search(index, '') == []
+
+    def test_handle_frames_search(self):
+        '''Answer normalized, prefix and fuzzy lookups'''
+        frames = [(1, OP_GET, b'united states'), (2, OP_PREFIX, b'Alb'), (3, OP_FUZZY, b'qqqq')]
+        assert handle_frames(self.dataset, frames) == \
+            encode_frame(1, OP_GET, b'Washington, D.C.') + \
+            encode_frame(2, OP_PREFIX, b'Albania - Tirana') + \
+            encode_frame(3, OP_FUZZY, b'NOT FOUND')
+
+    def test_worker_stats(self, capsys):
+        '''Publish worker counters into a shared array and total them'''
+        shared = RawArray('q', 2 * len(STAT_FIELDS))
+        first = dict(new_stats(), connections=3, requests=10)
+        second = dict(new_stats(), connections=2, active=1, requests=5, reloads=1)
+        publish_stats(first, shared, 0)
+        publish_stats(second, shared, 1)
+        assert read_stats(shared, 0) == first
+        assert read_stats(shared, 1) == second
+        report_workers(shared, 2)
+        assert capsys.readouterr().out.splitlines()[-1].endswith(
+            'Total: Connections: 5 total, 1 active, Requests: 15, Reloads: 1')
+
+    def test_serve_async(self, capsys):
+        '''Serve pipelined lookups to several clients at once'''
+        state = {'dataset': self.dataset}
+        stats = new_stats()
+        port = None
+
+        def client():
+            with socket(AF_INET, SOCK_STREAM) as s:
+                s.settimeout(5)
+                s.connect(('127.0.0.1', port))
+                return lookup_many(s, bytearray(), ['Albania', 'Peru', 'Atlantis'])
+
+        async def run():
+            nonlocal port
+            server = asyncio.create_task(serve_async(state, stats, '127.0.0.1', 0))
+            while 'server' not in state:
+                await asyncio.sleep(0.01)
+            port = state['server'].sockets[0].getsockname()[1]
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(loop.run_in_executor(None, client) for _ in range(5)))
+            while stats['active']:
+                await asyncio.sleep(0.01)
+            state['server'].close()
+            await asyncio.gather(server, return_exceptions=True)
+            return results
+
+        results = asyncio.run(run())
+        assert results == [['Tirana', 'Lima', 'NOT FOUND']] * 5
+        assert stats == dict(new_stats(), connections=5, requests=15)
+        assert 'Listening on 127.0.0.1:{} (asyncio)'.format(port) in capsys.readouterr().out
+
+    def test_serve_workers(self):
+        '''Share one port between worker processes and total their counters on SIGTERM'''
+        with socket(AF_INET, SOCK_STREAM) as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        code = 'import geo_server_tcp as g; g.serve_workers(g.load_dataset(g.FILE_NAME), 2, "127.0.0.1", {})'.format(port)
+        parent = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=subprocess.PIPE, text=True)
+        try:
+            deadline = time.monotonic() + 10
+            results = []
+            while len(results) < 6:
+                try:
+                    with socket(AF_INET, SOCK_STREAM) as s:
+                        s.settimeout(5)
+                        s.connect(('127.0.0.1', port))
+                        results.append(lookup_many(s, bytearray(), ['Albania', 'Peru', 'Atlantis']))
+                except ConnectionRefusedError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+            parent.send_signal(signal.SIGTERM)
+            out, _ = parent.communicate(timeout=10)
+        finally:
+            parent.kill()
+        assert results == [['Tirana', 'Lima', 'NOT FOUND']] * 6
+        assert len(re.findall(r'Worker \d: ', out)) == 2
+        assert re.search(r'Total: Connections: 6 total, \d+ active, Requests: 18, Reloads: 0', out)
+
+    def test_watch_dataset(self, tmp_path):
+        '''Swap in a new dataset when the file changes'''
+        filename = str(tmp_path / 'world.txt')
+        with open(filename, 'w') as f:
+            f.write('Albania - Tirana\n')
+        state = {'dataset': load_dataset(filename)}
+        stats = new_stats()
+
+        async def change_file():
+            watcher = asyncio.create_task(watch_dataset(filename, state, stats, interval=0.01))
+            await asyncio.sleep(0.05)
+            with open(filename, 'w') as f:
+                f.write('Albania - Tirana\nAtlantis - Poseidonia\n\n')
+            await asyncio.sleep(0.2)
+            watcher.cancel()
+
+        asyncio.run(change_file())
+        assert stats['reloads'] == 1
+        assert lookup(state['dataset'], 'Atlantis') == 'Poseidonia'
+
+    def test_compact_dataset(self, tmp_path):
+        '''Look up entries in a memory-mapped compact dataset'''
+        filename = str(tmp_path / 'world.geo')
+        write_compact(self.dataset['world'], filename)
+        world = CompactWorld(filename)
+        assert len(world) == len(self.dataset['world'])
+        assert world['Albania'] == 'Tirana'
+        assert world['Réunion'] == self.dataset['world']['Réunion']
+        assert 'Atlantis' not in world
+        assert world.keys_with_prefix('United S', 5) == ['United States', 'United States Virgin Islands']
+        assert list(world) == sorted(self.dataset['world'], key=lambda name: name.encode('utf-8'))
+        world.close()
+
+        dataset = load_dataset(filename)
+        frames = [(1, OP_MGET, b'Peru\nperu'), (2, OP_PREFIX, b'Alb'), (3, OP_FUZZY, b'Albnia')]
+        assert handle_frames(dataset, frames) == \
+            encode_frame(1, OP_MGET, b'Lima\nNOT FOUND') + \
+            encode_frame(2, OP_PREFIX, b'Albania - Tirana') + \
+            encode_frame(3, OP_FUZZY, b'NOT FOUND')
+        dataset['world'].close()
+
+    def test_bench_sampler(self):
+        '''Draw keys from the benchmark distributions'''
+        keys = ['a', 'b', 'c', 'd']
+        sample = make_sampler(keys, 'zipf', random.Random(430), zipf_s=2)
+        draws = [sample() for _ in range(1000)]
+        assert draws.count('a') > draws.count('b') > draws.count('d')
+        sample = make_sampler(keys, 'miss', random.Random(430), miss_ratio=1)
+        assert all(sample() not in keys for _ in range(100))
+        with pytest.raises(ValueError):
+            make_sampler(keys, 'gaussian', random.Random(430))
+
+    def test_bench_percentile(self):
+        '''Compute latency percentiles and histogram buckets'''
+        latencies = [i / 1000 for i in range(1, 1001)]
+        assert percentile(latencies, 50) == 0.5
+        assert percentile(latencies, 99.9) == 0.999
+        assert percentile([], 99) == 0.0
+        assert histogram([0.000001, 0.000003, 0.000004]) == [(1, 1), (4, 2)]
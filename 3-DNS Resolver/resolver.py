@@ -1,12 +1,65 @@
 #!/usr/bin/env python3
 
+import asyncio
+import ipaddress
+import json
+import os
+import sqlite3
+import struct
 import sys
-from random import randint, choice, seed
-from socket import socket, SOCK_DGRAM, AF_INET
+import threading
+import time
+from collections import OrderedDict, deque
+from random import choice
+from secrets import randbits
+from socket import socket, create_connection, inet_pton, SOCK_DGRAM, AF_INET, AF_INET6, timeout as SocketTimeout
 
 
 PORT = 53
 
+CACHE_SIZE = 10000
+NEGATIVE_TTL = 300
+CACHE_FILE = os.environ.get('DNS_CACHE_FILE')
+PREFETCH_HITS = 3
+PREFETCH_RATIO = 0.1
+STALE_TTL = int(os.environ.get('DNS_SERVE_STALE', '0'))
+STALE_ANSWER_TTL = 30
+STALE_TIMEOUT = 1.8
+
+BULK_CONCURRENCY = 100
+BULK_SOCKETS = 4
+
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 5300
+UDP_PAYLOAD = 512
+TCP_PAYLOAD = 65535
+TCP_IDLE_TIMEOUT = 10
+
+TIMEOUT = 1.0
+MAX_TIMEOUT = 5.0
+BACKOFF = 2
+ATTEMPTS = 4
+FAILURE_LIMIT = 3
+HOLDDOWN = 30
+RACE = int(os.environ.get('DNS_RACE', '1'))
+ERROR_ALPHA = 0.25
+ERROR_PENALTY = 1.0
+SCORE_HALF_LIFE = 60
+
+EDNS_PAYLOAD = 1232
+RECV_SIZE = 65535
+TCP_POOL_SIZE = 2
+
+MAX_REFERRALS = 16
+MAX_DEPTH = 8
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
 DNS_TYPES = {
     'A': 1,
     'AAAA': 28,
@@ -17,6 +70,20 @@ DNS_TYPES = {
     'TXT': 16
 }
 
+OPT_TYPE = 41
+SOA_TYPE = 6
+NAME_TYPES = (DNS_TYPES['CNAME'], DNS_TYPES['NS'], DNS_TYPES['PTR'])
+
+HEADER = struct.Struct('>HHHHHH')
+QUESTION = struct.Struct('>HH')
+RR_HEADER = struct.Struct('>HHIH')
+OPT_RECORD = struct.Struct('>BHHIH')
+SOA_FIELDS = struct.Struct('>IIIII')
+TCP_LENGTH = struct.Struct('>H')
+MAX_NAME_LENGTH = 255
+MAX_CNAME_CHAIN = 16
+QNAME_CACHE_SIZE = 10000
+
 PUBLIC_DNS_SERVER = [
     '1.0.0.1',  # Cloudflare
     '1.1.1.1',  # Cloudflare
@@ -30,6 +97,48 @@ PUBLIC_DNS_SERVER = [
     '208.67.220.220'  # OpenDNS
 ]
 
+ROOT_HINTS = [
+    '198.41.0.4',  # a.root-servers.net
+    '170.247.170.2',  # b.root-servers.net
+    '192.33.4.12',  # c.root-servers.net
+    '199.7.91.13',  # d.root-servers.net
+    '192.203.230.10',  # e.root-servers.net
+    '192.5.5.241',  # f.root-servers.net
+    '192.112.36.4',  # g.root-servers.net
+    '198.97.190.53',  # h.root-servers.net
+    '192.36.148.17',  # i.root-servers.net
+    '192.58.128.30',  # j.root-servers.net
+    '193.0.14.129',  # k.root-servers.net
+    '199.7.83.42',  # l.root-servers.net
+    '202.12.27.33'  # m.root-servers.net
+]
+
+# (domain, type) -> [expires at, answers, stored at, hits, rcode], least recently used first
+CACHE = OrderedDict()
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'coalesced': 0, 'prefetches': 0, 'stale': 0}
+
+# (domain, type) -> task of the upstream lookup in flight
+IN_FLIGHT = dict()
+
+# Optional sqlite connection to the persistent cache shared across invocations
+CACHE_DB = None
+
+# server -> {'srtt', 'rttvar', 'errors', 'updated', 'failures', 'down_until'}
+SERVER_STATS = dict()
+
+# server -> idle TCP connections, most recently used last
+TCP_POOL = dict()
+TCP_POOL_LOCK = threading.Lock()
+
+# Iterative mode: zone -> (expires at, name server names), and name server -> (expires at, addresses)
+DELEGATIONS = dict()
+GLUE = dict()
+
+# labels -> encoded QNAME, oldest first
+QNAMES = dict()
+# Scratch buffer encode_query builds queries in
+QUERY_BUFFER = bytearray(HEADER.size + MAX_NAME_LENGTH + QUESTION.size + OPT_RECORD.size)
+
 
 def val_to_2_bytes(value: int) -> list:
     '''Split a value into 2 bytes'''
@@ -118,15 +227,14 @@ def parse_cli_query(filename, q_type, q_domain, q_server=None) -> tuple:
         parse_cli_query takes a filename, a query type, the domain name to resolve, and an optional server address as parameters and returns a tuple of the numeric value of the query type (as found in the DNS_TYPES dictionary), domain name (as a list of strings), and the server address. If the server address is not specified, pick one randomly as follows: choice(PUBLIC_DNS_SERVER).
     '''
 
-    q_num = 0
-    if q_type == "A":
-        q_num = DNS_TYPES[q_type]
-    elif q_type == "AAAA":
-        q_num = DNS_TYPES[q_type]
-    else:
+    if q_type not in DNS_TYPES:
         raise ValueError("Unknown query type")
+    q_num = DNS_TYPES[q_type]
 
-    q_domain = q_domain.split(".")
+    if q_type == 'PTR' and is_address(q_domain):
+        q_domain = reverse_name(q_domain)
+    else:
+        q_domain = q_domain.split(".")
 
     if q_server == None:
         q_server = choice(PUBLIC_DNS_SERVER)
@@ -134,7 +242,27 @@ def parse_cli_query(filename, q_type, q_domain, q_server=None) -> tuple:
     return (q_num, q_domain, q_server)
 
 
-def format_query(q_type: int, q_domain: list) -> bytearray:
+def is_address(text: str) -> bool:
+    '''Check whether a string is an IPv4 or IPv6 address'''
+    try:
+        ipaddress.ip_address(text)
+    except ValueError:
+        return False
+    return True
+
+
+def reverse_name(address: str) -> list:
+    '''Build the name to query for the host name of an address: in-addr.arpa for IPv4, ip6.arpa for IPv6'''
+
+    '''
+        assert reverse_name('192.0.2.1') == ['1', '2', '0', '192', 'in-addr', 'arpa']
+    '''
+
+    return ipaddress.ip_address(address).reverse_pointer.split('.')
+
+
+def format_query(q_type: int, q_domain: list, trans_id: int = None, recursion: bool = True,
+                 payload_size: int = None) -> bytearray:
     '''Format DNS query'''
     '''
         Head is always 12 bytes - Query, message size of varying size ending with 00 - Answers
@@ -158,13 +286,13 @@ def format_query(q_type: int, q_domain: list) -> bytearray:
 
     '''
         assert format_query(
-            1, ['luther', 'edu']) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
+            1, ['luther', 'edu'], 0x4f42) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
 
         # OB is transaction id - convert each of those characters including space back into hexadecimal
     '''
 
     '''
-        format_query takes the query type and the domain name as parameters and builds a query as a bytearray. Bytearrays are mutable byte sequences in Python, so you should start with an empty one and use append or extend to form a valid DNS query. Transaction id should be chosen at random as follows: randint(0, 65535). Use default value, 0x100 for the flags. The domain name should be in the QNAME format, terminated by \0.
+        format_query takes the query type and the domain name as parameters and builds a query as a bytearray. Bytearrays are mutable byte sequences in Python, so you should start with an empty one and use append or extend to form a valid DNS query. Transaction id should be chosen at random as follows: randbits(16), from the secrets module, since ids an off-path attacker could predict would let spoofed responses through. Use default value, 0x100 for the flags. The domain name should be in the QNAME format, terminated by \0.
 
         56 f0 01 00 00 01 00 00 00 00 00 00 06 6c 75 74 68 65 72 03 65 64 75 00 00 01 00 01
         |---| |---| |---| |---| |---| |---| |------------------| |---------| || |---| |---|
@@ -173,21 +301,22 @@ def format_query(q_type: int, q_domain: list) -> bytearray:
 
     formatted_query = bytearray()
 
-    # problem here, to pass the test, you need the trans_id_bytes to be:
-    trans_id_bytes = b'OB'
-    # trans_id = randint(0, 65535)
-    # trans_id_bytes = val_to_2_bytes(trans_id)
+    if trans_id is None:
+        trans_id = randbits(16)
+    trans_id_bytes = val_to_2_bytes(trans_id)
 
     formatted_query.extend(trans_id_bytes)
 
-    flag_bytes = val_to_2_bytes(int('0100', 16))
+    flag_bytes = val_to_2_bytes(int('0100', 16) if recursion else 0)
     formatted_query.extend(flag_bytes)
 
     questions_bytes = val_to_2_bytes(1)
     formatted_query.extend(questions_bytes)
 
-    others_bytes = val_to_n_bytes(0, 6)
+    others_bytes = val_to_n_bytes(0, 4)
     formatted_query.extend(others_bytes)
+    additional_bytes = val_to_2_bytes(0 if payload_size is None else 1)
+    formatted_query.extend(additional_bytes)
 
     for domain in q_domain:
         length_bytes = val_to_n_bytes(len(domain), 1)
@@ -202,66 +331,556 @@ def format_query(q_type: int, q_domain: list) -> bytearray:
     class_bytes = val_to_2_bytes(1)
     formatted_query.extend(class_bytes)
 
+    if payload_size is not None:
+        formatted_query.extend(format_opt(payload_size))
+
     return bytes(formatted_query)
 
 
-def send_request(q_message: bytearray, q_server: str) -> bytes:
+def format_opt(payload_size: int) -> bytes:
+    '''Format an EDNS0 OPT record advertising the UDP payload size we can receive'''
+
+    '''
+        00 00 29 04 d0 00 00 00 00 00 00
+        || |---| |---| |---------| |---|
+        \0 |typ| |size| |rcode,ver| |len|
+    '''
+
+    return bytes([0] + val_to_2_bytes(OPT_TYPE) + val_to_2_bytes(payload_size) + val_to_n_bytes(0, 6))
+
+
+def send_request(q_message: bytearray, q_server: str, timeout: float = None) -> bytes:
     '''Contact the server'''
 
     '''
         send_request takes the formatted message and the server address and sends the DNS request. This function returns the DNS response for the parser to process.
     '''
 
+    '''
+        The socket is connected, so the kernel drops datagrams from other addresses; responses that do not match the query are ignored. With a timeout, socket.timeout is raised if no matching response arrives in time.
+    '''
+
     client_sckt = socket(AF_INET, SOCK_DGRAM)
-    client_sckt.sendto(q_message, (q_server, PORT))
-    (q_response, _) = client_sckt.recvfrom(2048)
-    client_sckt.close()
+    try:
+        client_sckt.connect((q_server, PORT))
+        client_sckt.send(q_message)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None:
+                client_sckt.settimeout(max(deadline - time.monotonic(), 0))
+            q_response = client_sckt.recv(RECV_SIZE)
+            if match_response(q_message, q_response):
+                break
+    finally:
+        client_sckt.close()
 
     return q_response
 
 
-def parse_response(resp_bytes: bytes):
-    '''Parse server response'''
+def recv_exactly(sckt: socket, n_bytes: int) -> bytes:
+    '''Receive exactly n_bytes from a stream socket'''
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < n_bytes:
+        n = sckt.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Connection closed by the server')
+        received += n
+    view.release()
+    return bytes(buffer)
+
+
+def send_request_tcp(q_message: bytes, q_server: str, timeout: float = None) -> bytes:
+    '''Send a query over TCP, for responses too large for UDP'''
 
     '''
-        c00c means go back to the query since we received a label and we want to know our domain name.
-        Extract
-        2bytes
+        Messages over TCP are prefixed with their length on 2 bytes. Connections are kept in TCP_POOL after use, up to TCP_POOL_SIZE per server, and the next query to the same server reuses one; if the server has closed it in the meantime, the query is retried on a new connection. The pool is shared by the executor threads of the async path, so it is only touched under TCP_POOL_LOCK.
+    '''
+
+    timeout = TIMEOUT if timeout is None else timeout
+    while True:
+        with TCP_POOL_LOCK:
+            idle = TCP_POOL.setdefault(q_server, [])
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if not reused:
+            conn = create_connection((q_server, PORT), timeout)
+        try:
+            conn.settimeout(timeout)
+            conn.sendall(TCP_LENGTH.pack(len(q_message)) + q_message)
+            q_response = recv_exactly(conn, TCP_LENGTH.unpack(recv_exactly(conn, TCP_LENGTH.size))[0])
+        except OSError:
+            conn.close()
+            if reused:
+                continue
+            raise
+        if not match_response(q_message, q_response):
+            conn.close()
+            raise ConnectionError('Response over TCP does not match the query')
+        with TCP_POOL_LOCK:
+            idle = TCP_POOL.setdefault(q_server, [])
+            if len(idle) < TCP_POOL_SIZE:
+                idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return q_response
+
+
+def close_tcp_pool() -> None:
+    '''Close the idle TCP connections'''
+    with TCP_POOL_LOCK:
+        for idle in TCP_POOL.values():
+            for conn in idle:
+                conn.close()
+        TCP_POOL.clear()
+
+
+def is_truncated(resp_bytes: bytes) -> bool:
+    '''Check the TC bit, set when the response did not fit in a UDP datagram'''
+    return bool(resp_bytes[2] & 0x02)
+
+
+def server_stats(q_server: str) -> dict:
+    '''Get (and create if needed) the statistics of a server'''
+    return SERVER_STATS.setdefault(q_server, {'srtt': None, 'rttvar': 0.0, 'errors': 0.0, 'updated': 0.0,
+                                              'failures': 0, 'down_until': 0.0})
+
+
+def decay_errors(stats: dict, now: float) -> None:
+    '''Let the error score fade, halving every SCORE_HALF_LIFE seconds'''
+    stats['errors'] *= 0.5 ** (max(now - stats['updated'], 0) / SCORE_HALF_LIFE)
+    stats['updated'] = now
+
+
+def record_rtt(q_server: str, rtt: float, now: float = None) -> None:
+    '''Update the smoothed RTT and error score of a server after a response'''
 
-        The tuple sends back 4bytes of time to live in the middle in seconds
+    '''
+        Same estimator as TCP (RFC 6298): srtt moves 1/8 of the way towards each sample and rttvar 1/4 of the way towards the deviation.
+    '''
+
+    now = time.monotonic() if now is None else now
+    stats = server_stats(q_server)
+    if stats['srtt'] is None:
+        stats['srtt'] = rtt
+        stats['rttvar'] = rtt / 2
+    else:
+        stats['rttvar'] = 0.75 * stats['rttvar'] + 0.25 * abs(stats['srtt'] - rtt)
+        stats['srtt'] = 0.875 * stats['srtt'] + 0.125 * rtt
+    decay_errors(stats, now)
+    stats['errors'] *= 1 - ERROR_ALPHA
+    stats['failures'] = 0
+    stats['down_until'] = 0.0
 
-        Your answe starts at the offset, 12 bytes for the DNS Header, whatever for query, and then the answer in the offset.
 
-        Two offsets:
+def record_lost(q_server: str, rtt: float) -> None:
+    '''Back off the smoothed RTT of a server that was still silent when another won a race'''
 
-        The offset starts with 11 C0
     '''
+        All that is known is that it takes longer than the winner, so its srtt is raised to BACKOFF times the winner's RTT if below that. Its failure count and error score are left alone: it may still answer, just too late.
+    '''
+
+    stats = server_stats(q_server)
+    if stats['srtt'] is None or stats['srtt'] < BACKOFF * rtt:
+        stats['srtt'] = BACKOFF * rtt
+        stats['rttvar'] = max(stats['rttvar'], rtt / 2)
+
+
+def record_failure(q_server: str, now: float = None) -> None:
+    '''Count a failed query; after FAILURE_LIMIT in a row the server is avoided for HOLDDOWN seconds'''
+    now = time.monotonic() if now is None else now
+    stats = server_stats(q_server)
+    decay_errors(stats, now)
+    stats['errors'] = stats['errors'] * (1 - ERROR_ALPHA) + ERROR_ALPHA
+    stats['failures'] += 1
+    if stats['failures'] >= FAILURE_LIMIT:
+        stats['down_until'] = now + HOLDDOWN
+
+
+def server_score(q_server: str, now: float = None) -> float:
+    '''Expected cost of asking a server, in seconds: its smoothed RTT plus a fading penalty for recent errors'''
+    now = time.monotonic() if now is None else now
+    stats = SERVER_STATS.get(q_server)
+    if stats is None:
+        return 0.0
+    errors = stats['errors'] * 0.5 ** (max(now - stats['updated'], 0) / SCORE_HALF_LIFE)
+    return (stats['srtt'] or 0.0) + ERROR_PENALTY * errors
+
+
+def rank_servers(servers: list, now: float = None) -> list:
+    '''Order servers by health, then by score'''
 
     '''
-        parse_response takes bytes received from the server and returns a list (or a tuple, it doesn't matter) where each item is a tuple of the domain name, TTL, and the address, as extracted from the server response. This function processes the response header (first 12 bytes and the query), calls parse_answers to parse the specific answer(s), and returns the results returned by parse_answers. You don't need to validate values in the response (i.e. transaction id and flags) but you have to extract the number of answers from the header and the starting byte of the answers.
+        Servers held down after repeated failures go last. Servers without a measurement keep their given order ahead of measured ones, so each gets probed.
     '''
 
-    no_of_answers = resp_bytes[6:8]
-    length = int(no_of_answers.hex(), 16)
-    return parse_answers(resp_bytes, resp_bytes.find(b'\xc0\x0c'), length)
+    now = time.monotonic() if now is None else now
 
+    def rank(q_server):
+        stats = SERVER_STATS.get(q_server)
+        return (stats is not None and stats['down_until'] > now, server_score(q_server, now))
 
-def parse_answers(resp_bytes: bytes, offset: int, rr_ans: int) -> list:
-    '''Parse DNS server answers'''
+    return sorted(servers, key=rank)
+
+
+def candidate_servers(q_server: str, failover: bool = True) -> list:
+    '''Servers to try for a query: the chosen one alone, or all known ones ranked'''
+    if not failover:
+        return [q_server]
+    return rank_servers([q_server] + [server for server in PUBLIC_DNS_SERVER if server != q_server])
+
+
+def attempt_timeout(attempt: int) -> float:
+    '''Timeout of the given attempt, backing off exponentially'''
+    return min(TIMEOUT * BACKOFF ** attempt, MAX_TIMEOUT)
+
+
+def attempt_servers(servers: list, attempt: int, race: int) -> list:
+    '''Servers to send the given attempt to: the next race servers of the ranked list'''
+    race = min(max(race, 1), len(servers))
+    return [servers[(attempt * race + i) % len(servers)] for i in range(race)]
+
+
+def is_server_error(resp_bytes: bytes) -> bool:
+    '''Check whether a response means the server could not answer (SERVFAIL or REFUSED)'''
+    return get_rcode(resp_bytes) in (RCODE_SERVFAIL, RCODE_REFUSED)
+
+
+def race_request(q_message: bytes, q_servers: list, timeout: float) -> tuple:
+    '''Send a query to several servers at once, returning the first good response and its server'''
+
+    '''
+        An error response (SERVFAIL, REFUSED) only wins if every server answers with one. The servers still silent when one wins are backed off with record_lost; all of them count a failure on timeout.
+    '''
+
+    client_sckt = socket(AF_INET, SOCK_DGRAM)
+    start = time.monotonic()
+    error_response = None
+    answered = set()
+    try:
+        for q_server in q_servers:
+            client_sckt.sendto(q_message, (q_server, PORT))
+        while len(answered) < len(q_servers):
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                break
+            client_sckt.settimeout(remaining)
+            try:
+                q_response, addr = client_sckt.recvfrom(RECV_SIZE)
+            except SocketTimeout:
+                break
+            if addr[0] not in q_servers or addr[0] in answered or not match_response(q_message, q_response):
+                continue
+            answered.add(addr[0])
+            if is_server_error(q_response):
+                record_failure(addr[0])
+                error_response = (q_response, addr[0])
+                continue
+            rtt = time.monotonic() - start
+            record_rtt(addr[0], rtt)
+            for q_server in q_servers:
+                if q_server not in answered:
+                    record_lost(q_server, rtt)
+            return q_response, addr[0]
+    finally:
+        client_sckt.close()
+
+    for q_server in q_servers:
+        if q_server not in answered:
+            record_failure(q_server)
+    if error_response is not None:
+        return error_response
+    raise SocketTimeout('timed out')
+
+
+def exchange(q_message: bytes, q_servers: list, timeout: float) -> tuple:
+    '''Make one attempt at a query, returning the response and the server that gave it'''
+    if len(q_servers) > 1:
+        return race_request(q_message, q_servers, timeout)
+
+    q_server = q_servers[0]
+    start = time.monotonic()
+    try:
+        resp_bytes = send_request(q_message, q_server, timeout)
+    except OSError:
+        record_failure(q_server)
+        raise
+    if is_server_error(resp_bytes):
+        record_failure(q_server)
+    else:
+        record_rtt(q_server, time.monotonic() - start)
+    return resp_bytes, q_server
+
+
+def without_edns(q_message: bytes) -> bytes:
+    '''Drop the OPT record of a query, for servers that reject EDNS0'''
+    with memoryview(q_message) as msg:
+        _, q_end = parse_question(msg, HEADER.size)
+    return q_message[:10] + b'\x00\x00' + q_message[HEADER.size:q_end]
+
+
+def query_servers(q_message: bytes, servers: list, race: int = None, budget: float = None) -> tuple:
+    '''Send a query with retransmission and failover, returning the response and the server that gave it'''
+
+    '''
+        Up to ATTEMPTS tries are made, moving down the server list on every timeout, network error, SERVFAIL or REFUSED, and doubling the timeout each time. With race above 1 (RACE by default), every try goes to that many servers at once and the first good response wins. A FORMERR or NOTIMP to a query with an OPT record is asked again from the same server without it (RFC 6891 section 7), and later tries leave it out too. A truncated response is asked again over TCP from the same server. With a budget, the tries stop after that many seconds. If every try fails, the last error response is returned, or the last exception raised.
+    '''
+
+    race = RACE if race is None else race
+    deadline = None if budget is None else time.monotonic() + budget
+    response = None
+    error = SocketTimeout('timed out')
+    for attempt in range(ATTEMPTS):
+        timeout = attempt_timeout(attempt)
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+        try:
+            resp_bytes, q_server = exchange(q_message, attempt_servers(servers, attempt, race), timeout)
+            if get_rcode(resp_bytes) in (RCODE_FORMERR, RCODE_NOTIMP) and q_message[10:12] != b'\x00\x00':
+                q_message = without_edns(q_message)
+                resp_bytes = send_request(q_message, q_server, timeout)
+            if is_truncated(resp_bytes):
+                resp_bytes = send_request_tcp(q_message, q_server, timeout)
+        except OSError as e:
+            error = e
+            continue
+        if is_server_error(resp_bytes):
+            response = (resp_bytes, q_server)
+            continue
+        return resp_bytes, q_server
+    if response is not None:
+        return response
+    raise error
+
+
+def get_question(msg: bytes) -> bytes:
+    '''Extract the question section (QNAME, QTYPE and QCLASS) of a message, lowercased'''
+    offset = 12
+    while msg[offset] != 0:
+        if msg[offset] >= 0xC0:
+            offset += 1
+            break
+        offset += msg[offset] + 1
+    return bytes(msg[12:offset + 5]).lower()
+
+
+def match_response(q_message: bytes, resp_bytes: bytes) -> bool:
+    '''Check that a response answers the query: same transaction id, QR bit set and same question'''
+    if len(resp_bytes) < 12 or resp_bytes[0:2] != q_message[0:2] or not resp_bytes[2] & 0x80:
+        return False
+    try:
+        return get_question(resp_bytes) == get_question(q_message)
+    except IndexError:
+        return False
+
+
+def encode_qname(q_domain: list) -> bytes:
+    '''Encode a domain name as length-prefixed labels, caching the result'''
 
     '''
-        c00c means go back to the query since we received a label and we want to know our domain name.
-        Extract
-        2bytes
+        An empty last label stands for the root, as in a name written with a trailing dot, so [''] encodes the root like []. An empty label anywhere else is an error.
+    '''
+
+    key = tuple(q_domain)
+    qname = QNAMES.get(key)
+    if qname is not None:
+        return qname
+
+    qname = bytearray()
+    for i, label in enumerate(q_domain):
+        if not label:
+            if i < len(q_domain) - 1:
+                raise ValueError('Empty label in {}'.format('.'.join(q_domain)))
+            continue
+        label = label.encode('utf-8')
+        if len(label) > 63:
+            raise ValueError('Label longer than 63 bytes: {}'.format(label))
+        qname.append(len(label))
+        qname.extend(label)
+    qname.append(0)
+    if len(qname) > MAX_NAME_LENGTH:
+        raise ValueError('Name longer than {} bytes'.format(MAX_NAME_LENGTH))
+    if len(QNAMES) >= QNAME_CACHE_SIZE:
+        del QNAMES[next(iter(QNAMES))]
+    qname = QNAMES[key] = bytes(qname)
+    return qname
+
+
+def encode_query_into(buffer: bytearray, q_type: int, q_domain: list, trans_id: int, recursion: bool = True,
+                      payload_size: int = None) -> int:
+    '''Write a query into a buffer, returning its length'''
+    qname = encode_qname(q_domain)
+    HEADER.pack_into(buffer, 0, trans_id, 0x0100 if recursion else 0, 1, 0, 0, 0 if payload_size is None else 1)
+    end = HEADER.size + len(qname)
+    buffer[HEADER.size:end] = qname
+    QUESTION.pack_into(buffer, end, q_type, 1)
+    end += QUESTION.size
+    if payload_size is not None:
+        OPT_RECORD.pack_into(buffer, end, 0, OPT_TYPE, payload_size, 0, 0)
+        end += OPT_RECORD.size
+    return end
+
+
+def encode_query(q_type: int, q_domain: list, trans_id: int = None, recursion: bool = True,
+                 payload_size: int = None) -> bytes:
+    '''Build the same query as format_query, faster'''
 
-        The tuple sends back 4bytes of time to live in the middle in seconds
+    '''
+        format_query builds the message piece by piece through lists of byte values. encode_query packs the header, question and OPT record with precompiled structs into QUERY_BUFFER, which is reused across calls, and takes the QNAME from a cache, so the only new object per query is the returned bytes. QUERY_BUFFER is shared, so queries must be encoded from one thread at a time.
+    '''
 
-        Your answe starts at the offset, 12 bytes for the DNS Header, whatever for query, and then the answer in the offset.
+    if trans_id is None:
+        trans_id = randbits(16)
+    end = encode_query_into(QUERY_BUFFER, q_type, q_domain, trans_id, recursion, payload_size)
+    return bytes(QUERY_BUFFER[:end])
 
-        Two offsets:
 
-        The offset starts with 11 C0
+def decode_name(msg: memoryview, offset: int) -> tuple:
+    '''Decode a domain name starting at offset, returning the name and the offset right after it'''
+
+    '''
+        A name is a sequence of length-prefixed labels ending with a zero byte, or with a pointer (two bytes starting with 0b11) to the rest of the name elsewhere in the message. A pointer must point before the labels that led to it, so a malicious message cannot make the parser loop.
+    '''
+
+    labels = []
+    length = 0
+    end = None
+    limit = offset
+    while True:
+        if offset >= len(msg):
+            raise ValueError('Name runs past the end of the message')
+        size = msg[offset]
+        if size >= 0xC0:
+            if offset + 1 >= len(msg):
+                raise ValueError('Truncated compression pointer')
+            pointer = get_domain_name_location(msg[offset:offset + 2])
+            if end is None:
+                end = offset + 2
+            if pointer >= limit:
+                raise ValueError('Compression pointer loop at {}'.format(offset))
+            offset = limit = pointer
+            continue
+        if size & 0xC0:
+            raise ValueError('Unknown label type {:#x}'.format(size))
+        if size == 0:
+            break
+        length += size + 1
+        if length > MAX_NAME_LENGTH:
+            raise ValueError('Name longer than {} bytes'.format(MAX_NAME_LENGTH))
+        if offset + 1 + size > len(msg):
+            raise ValueError('Label runs past the end of the message')
+        labels.append(str(msg[offset + 1:offset + 1 + size], 'utf-8', 'replace'))
+        offset += size + 1
+    return '.'.join(labels), offset + 1 if end is None else end
+
+
+def parse_header(msg: memoryview) -> dict:
+    '''Parse the 12-byte header of a message'''
+    if len(msg) < HEADER.size:
+        raise ValueError('Message shorter than its header')
+    trans_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(msg, 0)
+    return {'id': trans_id, 'flags': flags, 'rcode': flags & 0x0F, 'truncated': bool(flags & 0x0200),
+            'qdcount': qdcount, 'ancount': ancount, 'nscount': nscount, 'arcount': arcount}
+
+
+def parse_question(msg: memoryview, offset: int) -> tuple:
+    '''Parse a question entry, returning (name, type, class) and the offset of the next entry'''
+    name, offset = decode_name(msg, offset)
+    if offset + QUESTION.size > len(msg):
+        raise ValueError('Truncated question')
+    q_type, q_class = QUESTION.unpack_from(msg, offset)
+    return (name, q_type, q_class), offset + QUESTION.size
+
+
+def parse_rdata(msg: memoryview, r_type: int, offset: int, length: int) -> str:
+    '''Decode the data of a resource record'''
+
+    '''
+        Addresses are returned in their usual notation and CNAME, NS and PTR records as the name they hold. An MX record becomes "preference exchange" (e.g. "10 mail.luther.edu"), an SOA record "mname rname serial refresh retry expire minimum" and a TXT record the concatenation of its strings, as SPF and DKIM read them. Other types are returned as hex.
+    '''
+
+    rdata = msg[offset:offset + length]
+    if r_type == DNS_TYPES['A'] and length == 4:
+        return parse_address_a(4, rdata)
+    if r_type == DNS_TYPES['AAAA'] and length == 16:
+        return parse_address_aaaa(16, rdata)
+    if r_type in NAME_TYPES:
+        return decode_name(msg[:offset + length], offset)[0]
+    if r_type == DNS_TYPES['MX'] and length > 2:
+        return '{} {}'.format(bytes_to_val(rdata[:2]), decode_name(msg[:offset + length], offset + 2)[0])
+    if r_type == SOA_TYPE:
+        mname, end = decode_name(msg[:offset + length], offset)
+        rname, end = decode_name(msg[:offset + length], end)
+        if end + SOA_FIELDS.size != offset + length:
+            raise ValueError('SOA record has the wrong length')
+        return ' '.join([mname, rname] + [str(field) for field in SOA_FIELDS.unpack(msg[end:end + SOA_FIELDS.size])])
+    if r_type == DNS_TYPES['TXT']:
+        strings = []
+        i = 0
+        while i < length:
+            if i + 1 + rdata[i] > length:
+                raise ValueError('TXT string runs past the end of the record')
+            strings.append(str(rdata[i + 1:i + 1 + rdata[i]], 'utf-8', 'replace'))
+            i += 1 + rdata[i]
+        return ''.join(strings)
+    return rdata.hex()
+
+
+def parse_record(msg: memoryview, offset: int) -> tuple:
+    '''Parse a resource record, returning (name, type, class, ttl, data) and the offset of the next record'''
+    name, offset = decode_name(msg, offset)
+    if offset + RR_HEADER.size > len(msg):
+        raise ValueError('Truncated resource record')
+    r_type, r_class, ttl, length = RR_HEADER.unpack_from(msg, offset)
+    offset += RR_HEADER.size
+    if offset + length > len(msg):
+        raise ValueError('Resource record data runs past the end of the message')
+    return (name, r_type, r_class, ttl, parse_rdata(msg, r_type, offset, length)), offset + length
+
+
+def parse_message(resp_bytes: bytes) -> dict:
+    '''Parse a whole message: header, questions, answers, authority and additional records'''
+
+    '''
+        The message is read through a memoryview, so walking it does not copy the bytes; only the decoded names and values are new objects. Raises ValueError if the message is malformed.
+    '''
+
+    with memoryview(resp_bytes) as msg:
+        message = parse_header(msg)
+        offset = HEADER.size
+        message['questions'] = []
+        for _ in range(message['qdcount']):
+            question, offset = parse_question(msg, offset)
+            message['questions'].append(question)
+        for section, count in (('answers', 'ancount'), ('authority', 'nscount'), ('additional', 'arcount')):
+            message[section] = []
+            for _ in range(message[count]):
+                record, offset = parse_record(msg, offset)
+                message[section].append(record)
+    return message
+
+
+def parse_response(resp_bytes: bytes):
+    '''Parse server response'''
+
     '''
+        parse_response takes bytes received from the server and returns a list (or a tuple, it doesn't matter) where each item is a tuple of the domain name, TTL, and the address, as extracted from the server response. This function processes the response header (first 12 bytes and the query), calls parse_answers to parse the specific answer(s), and returns the results returned by parse_answers. You don't need to validate values in the response (i.e. transaction id and flags) but you have to extract the number of answers from the header and the starting byte of the answers.
+    '''
+
+    with memoryview(resp_bytes) as msg:
+        header = parse_header(msg)
+        offset = HEADER.size
+        for _ in range(header['qdcount']):
+            _, offset = parse_question(msg, offset)
+    return parse_answers(resp_bytes, offset, header['ancount'])
+
+
+def parse_answers(resp_bytes: bytes, offset: int, rr_ans: int) -> list:
+    '''Parse DNS server answers'''
 
     '''
         parse_answers takes the response message bytes, starting position for the answer(s) within the response, and the number of answers. It returns a list of tuples (domain, ttl, address). Do not confuse the offset in this function (a better(?) name would be number_of_bytes_from_the_beginning_of_the_response_to_the_first_answer) and the domain_name_start_offset. Keep in mind that the domain name may be in different format, label or pointer. You should be able to process both.
@@ -273,74 +892,39 @@ def parse_answers(resp_bytes: bytes, offset: int, rr_ans: int) -> list:
         |ptr| |typ| |cls| | ttl     | |len| | address |
     '''
 
-    ''' 0c location is the offset given to me, answer start after that
-        thus the domain is going to between 12 and offset -6'''
-
-    """ 
-    domain_lst = []
-    start_at = 12
-    stop_at = offset - 6
-    how_many = stop_at - start_at
-
-    domain_byte = resp_bytes[start_at:stop_at+1]
-
-    # \x05yahoo\x03com\x06osmaah'
-    idx_1 = 1
-    idx_2 = domain_byte[0]
-    while how_many != 0:
-        domain = domain_byte[idx_1:idx_2+2]
-        how_many -= len(domain)
-        idx_1 += idx_2+4
-        idx_2 = idx_1 + domain_byte[idx_1]
-        domain_lst.append(domain)
+    answers = []
+    with memoryview(resp_bytes) as msg:
+        for _ in range(rr_ans):
+            (name, _, _, ttl, data), offset = parse_record(msg, offset)
+            answers.append((name, ttl, data))
+    return answers
 
-    domain = '.'.join(domain_lst) 
-    """
 
-    domain_pt1_starts_at = resp_bytes[12]
-    domain_pt1 = resp_bytes[13:13+domain_pt1_starts_at].decode("utf-8")
-    domain_pt2_starts_at = resp_bytes[13+domain_pt1_starts_at]
-    domain_pt2 = resp_bytes[14+domain_pt1_starts_at:14 +
-                            domain_pt1_starts_at+domain_pt2_starts_at].decode("utf-8")
-    domain_name = '.'.join([domain_pt1, domain_pt2])
+def follow_cnames(records: list, q_type: int, q_name: str) -> tuple:
+    '''Follow the CNAME chain of a name through answer records'''
 
-    answers = []
-    # if it is labeled...
-    if offset == -1:
-        '''
-        x05yahoo\x03com\x00\x00\x01\x00\x01\x00\x00' +
-                              b'\x00\x05\x00\x04b\x89\xf6\x07\x05yahoo
-        '''
-        before, offset, after = resp_bytes.partition(bytes(domain_pt2, 'utf-8'))
-        resp_bytes = after
-        for answer in range(rr_ans):
-            before, offset, after = resp_bytes.partition(bytes(domain_pt2, 'utf-8'))
-            resp_bytes = after
-            print(after)
-            ttl = int(after[5:9].hex(), 16)
-            addr_length = int(after[9:11].hex(), 16)
-            ip = ""
-            if addr_length == 4:
-                ip = parse_address_a(4, after[11:11+addr_length])
-            elif addr_length == 16:
-                ip = parse_address_aaaa(16, after[11:11+addr_length])
-
-            answers.append((domain_name, ttl, ip))
-    else:
-        for answer in range(rr_ans):
-            before, offset, after = resp_bytes.partition(b'\xc0\x0c')
-            resp_bytes = after
-            ttl = int(after[4:8].hex(), 16)
-            addr_length = int(after[8:10].hex(), 16)
-            ip = ""
-            if addr_length == 4:
-                ip = parse_address_a(4, after[10:10+addr_length])
-            elif addr_length == 16:
-                ip = parse_address_aaaa(16, after[10:10+addr_length])
-
-            answers.append((domain_name, ttl, ip))
+    '''
+        follow_cnames takes (name, type, class, ttl, data) records, as returned by parse_message, and returns the canonical name at the end of the chain and the (domain, ttl, data) answers of q_type found for it. Their TTL is capped by the TTLs along the chain, since the answer is only valid while every alias is. A CNAME query returns the CNAME record itself.
+    '''
 
-    return answers
+    name = q_name.lower()
+    chain_ttl = None
+    seen = {name}
+    for _ in range(MAX_CNAME_CHAIN):
+        answers = [(r_name, r_ttl if chain_ttl is None else min(r_ttl, chain_ttl), data)
+                   for r_name, r_type, _, r_ttl, data in records if r_type == q_type and r_name.lower() == name]
+        if answers or q_type == DNS_TYPES['CNAME']:
+            return name, answers
+        alias = next((record for record in records
+                      if record[1] == DNS_TYPES['CNAME'] and record[0].lower() == name), None)
+        if alias is None:
+            return name, []
+        name = alias[4].lower()
+        chain_ttl = alias[3] if chain_ttl is None else min(alias[3], chain_ttl)
+        if name in seen:
+            raise ValueError('CNAME loop at {}'.format(name))
+        seen.add(name)
+    raise ValueError('CNAME chain longer than {}'.format(MAX_CNAME_CHAIN))
 
 
 def parse_address_a(addr_len: int, addr_bytes: bytes) -> str:
@@ -379,6 +963,960 @@ def parse_address_aaaa(addr_len: int, addr_bytes: bytes) -> str:
     return ':'.join(lst)
 
 
+def get_rcode(resp_bytes: bytes) -> int:
+    '''Extract the response code from the header'''
+    return resp_bytes[3] & 0x0F
+
+
+def cache_key(q_type: int, q_domain: list) -> tuple:
+    '''Build the cache key of a query'''
+    return ('.'.join(q_domain).lower(), q_type)
+
+
+def cache_get(q_type: int, q_domain: list, now: float = None) -> tuple:
+    '''Look up cached answers'''
+
+    '''
+        cache_get returns the response code and the cached answers, with their TTLs reduced by the time spent in the cache, or None on a miss. A cached negative answer has no answers and NOERROR (no data) or NXDOMAIN as its code. Expired entries are dropped, unless serve-stale keeps them for STALE_TTL more seconds.
+    '''
+
+    now = time.time() if now is None else now
+    key = cache_key(q_type, q_domain)
+    entry = CACHE.get(key)
+    if entry is None or entry[0] <= now:
+        if entry is not None and entry[0] + STALE_TTL <= now:
+            del CACHE[key]
+        CACHE_STATS['misses'] += 1
+        return None
+
+    CACHE.move_to_end(key)
+    CACHE_STATS['hits'] += 1
+    entry[3] += 1
+    expires, answers, stored, _, rcode = entry
+    age = int(now - stored)
+    return rcode, [(domain, max(ttl - age, 0), address) for domain, ttl, address in answers]
+
+
+def cache_put(q_type: int, q_domain: list, answers: list, rcode: int = RCODE_NOERROR, negative_ttl: int = None,
+              now: float = None) -> None:
+    '''Cache answers for as long as their smallest TTL, or negative_ttl (NEGATIVE_TTL by default) if there are none'''
+    now = time.time() if now is None else now
+    ttl = min(answer[1] for answer in answers) if answers else NEGATIVE_TTL if negative_ttl is None else negative_ttl
+    if ttl <= 0:
+        return
+
+    key = cache_key(q_type, q_domain)
+    CACHE[key] = [now + ttl, answers, now, 0, rcode]
+    CACHE.move_to_end(key)
+    while len(CACHE) > CACHE_SIZE:
+        CACHE.popitem(last=False)
+        CACHE_STATS['evictions'] += 1
+
+
+def cache_get_stale(q_type: int, q_domain: list, now: float = None) -> tuple:
+    '''Look up expired answers that may still be served, returning the response code and the answers, None if there are none'''
+
+    '''
+        With serve-stale enabled (DNS_SERVE_STALE, RFC 8767), answers stay usable for STALE_TTL seconds after they expire, for when the upstream servers cannot be reached. They are returned with a TTL of STALE_ANSWER_TTL, so clients come back soon.
+    '''
+
+    now = time.time() if now is None else now
+    entry = CACHE.get(cache_key(q_type, q_domain))
+    if entry is None or entry[0] > now or entry[0] + STALE_TTL <= now:
+        return None
+    return entry[4], [(domain, STALE_ANSWER_TTL, address) for domain, _, address in entry[1]]
+
+
+def prefetch_due(q_type: int, q_domain: list, now: float = None) -> bool:
+    '''Check whether a cached entry is hot and close enough to expiry to be refreshed in the background'''
+    now = time.time() if now is None else now
+    entry = CACHE.get(cache_key(q_type, q_domain))
+    return entry is not None and entry[3] >= PREFETCH_HITS and entry[0] - now <= PREFETCH_RATIO * (entry[0] - entry[2])
+
+
+def format_cache_stats() -> str:
+    '''Summarize CACHE_STATS on one line'''
+    return 'Cache: {hits} hits, {misses} misses, {evictions} evictions, {coalesced} coalesced, ' \
+           '{prefetches} prefetches, {stale} stale answers'.format(**CACHE_STATS)
+
+
+def open_cache_file(filename: str) -> sqlite3.Connection:
+    '''Open (and create if needed) the persistent cache'''
+
+    '''
+        The persistent cache is an sqlite database, so concurrent processes can share it safely: writers are serialized by sqlite's locking, and the WAL journal lets readers proceed while another process writes. Entries keep their absolute expiry time, so a later invocation sees the remaining TTL, and expired entries are kept STALE_TTL seconds more for serve-stale.
+    '''
+
+    db = sqlite3.connect(filename, timeout=5)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS answers ('
+               'name TEXT, type INTEGER, expires REAL, stored REAL, answers TEXT, rcode INTEGER DEFAULT 0, '
+               'PRIMARY KEY (name, type))')
+    if 'rcode' not in [column[1] for column in db.execute('PRAGMA table_info(answers)')]:
+        # Cache files written before the response code was kept
+        db.execute('ALTER TABLE answers ADD COLUMN rcode INTEGER DEFAULT 0')
+    db.execute('CREATE INDEX IF NOT EXISTS answers_expires ON answers (expires)')
+    return db
+
+
+def disk_cache_get(db: sqlite3.Connection, q_type: int, q_domain: list, now: float = None) -> tuple:
+    '''Look up answers in the persistent cache, returning the response code and the answers, None on a miss'''
+    now = time.time() if now is None else now
+    row = db.execute('SELECT expires, stored, answers, rcode FROM answers WHERE name = ? AND type = ? AND expires > ?',
+                     cache_key(q_type, q_domain) + (now,)).fetchone()
+    if row is None:
+        return None
+    expires, stored, answers, rcode = row
+    age = int(now - stored)
+    return rcode, [(domain, max(ttl - age, 0), address) for domain, ttl, address in json.loads(answers)]
+
+
+def disk_cache_get_stale(db: sqlite3.Connection, q_type: int, q_domain: list, now: float = None) -> tuple:
+    '''Look up expired answers that may still be served in the persistent cache, like cache_get_stale'''
+    now = time.time() if now is None else now
+    row = db.execute('SELECT answers, rcode FROM answers WHERE name = ? AND type = ? AND expires <= ? AND expires > ?',
+                     cache_key(q_type, q_domain) + (now, now - STALE_TTL)).fetchone()
+    if row is None:
+        return None
+    answers, rcode = row
+    return rcode, [(domain, STALE_ANSWER_TTL, address) for domain, _, address in json.loads(answers)]
+
+
+def disk_cache_put(db: sqlite3.Connection, q_type: int, q_domain: list, answers: list, rcode: int = RCODE_NOERROR,
+                   negative_ttl: int = None, now: float = None) -> None:
+    '''Store answers in the persistent cache and drop entries past serve-stale'''
+    now = time.time() if now is None else now
+    ttl = min(answer[1] for answer in answers) if answers else NEGATIVE_TTL if negative_ttl is None else negative_ttl
+    if ttl <= 0:
+        return
+    with db:
+        db.execute('DELETE FROM answers WHERE expires <= ?', (now - STALE_TTL,))
+        db.execute('INSERT OR REPLACE INTO answers (name, type, expires, stored, answers, rcode) VALUES (?, ?, ?, ?, ?, ?)',
+                   cache_key(q_type, q_domain) + (now + ttl, now, json.dumps(answers), rcode))
+
+
+def lookup(q_type: int, q_domain: list, q_server: str, failover: bool = True) -> tuple:
+    '''Answer a query from the cache, or from the server on a miss'''
+
+    '''
+        lookup returns a list of (domain, ttl, address) tuples and the server that answered ('cache' for a cached answer). The in-process cache is checked first, then the persistent cache if CACHE_DB is open. Answers and NXDOMAIN/empty responses are cached; other errors (e.g. SERVFAIL) are not. A failing persistent cache is skipped rather than failing the lookup. If serve-stale is enabled and there are expired answers, the servers get STALE_TIMEOUT seconds, and the expired answers are returned if they fail or run out of time.
+    '''
+
+    cached = cached_answers(q_type, q_domain)
+    if cached is not None:
+        return cached[1], 'cache'
+    stale = stale_answers(q_type, q_domain)
+    q_message = encode_query(q_type, q_domain, payload_size=EDNS_PAYLOAD)
+    try:
+        response_bytes, q_server = query_servers(q_message, candidate_servers(q_server, failover),
+                                                 budget=None if stale is None else STALE_TIMEOUT)
+    except OSError:
+        if stale is None:
+            raise
+        CACHE_STATS['stale'] += 1
+        return stale[1], 'cache (stale)'
+    if is_server_error(response_bytes) and stale is not None:
+        CACHE_STATS['stale'] += 1
+        return stale[1], 'cache (stale)'
+    return store_response(q_type, q_domain, response_bytes), q_server
+
+
+def cached_answers(q_type: int, q_domain: list) -> tuple:
+    '''Look up the in-process cache, then the persistent cache, returning the response code and the answers, None on a miss'''
+    cached = cache_get(q_type, q_domain)
+    if cached is not None or CACHE_DB is None:
+        return cached
+
+    try:
+        cached = disk_cache_get(CACHE_DB, q_type, q_domain)
+    except sqlite3.Error as e:
+        print('Ignoring the cache file: {}'.format(e), file=sys.stderr)
+    if cached is not None:
+        cache_put(q_type, q_domain, cached[1], cached[0])
+    return cached
+
+
+def stale_answers(q_type: int, q_domain: list) -> tuple:
+    '''Look up expired answers that may still be served in the in-process cache, then the persistent cache'''
+    stale = cache_get_stale(q_type, q_domain)
+    if stale is not None or CACHE_DB is None:
+        return stale
+    try:
+        return disk_cache_get_stale(CACHE_DB, q_type, q_domain)
+    except sqlite3.Error as e:
+        print('Ignoring the cache file: {}'.format(e), file=sys.stderr)
+    return None
+
+
+def negative_answer_ttl(message: dict) -> int:
+    '''How long to cache a response without answers: the lower of the TTL and MINIMUM field of its SOA record (RFC 2308), up to NEGATIVE_TTL'''
+    for _, r_type, _, ttl, data in message['authority']:
+        if r_type == SOA_TYPE:
+            return min(ttl, int(data.rsplit(' ', 1)[-1]), NEGATIVE_TTL)
+    return NEGATIVE_TTL
+
+
+def store_response(q_type: int, q_domain: list, response_bytes: bytes) -> list:
+    '''Parse a response, following CNAME chains, and cache its answers with its response code'''
+    message = parse_message(response_bytes)
+    _, answers = follow_cnames(message['answers'], q_type, '.'.join(q_domain))
+    if message['rcode'] in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        store_answers(q_type, q_domain, answers, message['rcode'], negative_answer_ttl(message))
+    return answers
+
+
+def store_answers(q_type: int, q_domain: list, answers: list, rcode: int = RCODE_NOERROR, negative_ttl: int = None) -> None:
+    '''Cache answers in process and, if there is one, in the cache file'''
+
+    '''
+        Answers that cannot be encoded back to the wire format, such as an AAAA record of 4 bytes, are not cached, so the daemon does not fail on them until they expire.
+    '''
+
+    if not encodable(q_type, answers):
+        return
+    cache_put(q_type, q_domain, answers, rcode, negative_ttl)
+    if CACHE_DB is not None:
+        try:
+            disk_cache_put(CACHE_DB, q_type, q_domain, answers, rcode, negative_ttl)
+        except sqlite3.Error as e:
+            print('Ignoring the cache file: {}'.format(e), file=sys.stderr)
+
+
+def in_zone(name: str, zone: str) -> bool:
+    '''Check whether a name is a zone or lies under it; the root zone is ""'''
+    return zone == '' or name == zone or name.endswith('.' + zone)
+
+
+def delegation_put(zone: str, ns_names: list, glue: dict, ttl: int, now: float = None) -> None:
+    '''Cache the name servers of a zone and the addresses known for them'''
+    now = time.time() if now is None else now
+    DELEGATIONS[zone] = (now + ttl, ns_names)
+    for ns_name, (glue_ttl, addresses) in glue.items():
+        GLUE[ns_name] = (now + glue_ttl, addresses)
+
+
+def glue_get(ns_name: str, now: float = None) -> list:
+    '''Cached addresses of a name server, None on a miss'''
+    now = time.time() if now is None else now
+    entry = GLUE.get(ns_name)
+    if entry is None or entry[0] <= now:
+        GLUE.pop(ns_name, None)
+        return None
+    return entry[1]
+
+
+def closest_delegation(name: str, now: float = None) -> tuple:
+    '''Find the deepest cached zone above a name, returning the zone and its name server names'''
+
+    '''
+        closest_delegation returns ('', None) when nothing below the root is cached, in which case the query starts from ROOT_HINTS.
+    '''
+
+    now = time.time() if now is None else now
+    labels = name.split('.') if name else []
+    for i in range(len(labels)):
+        zone = '.'.join(labels[i:])
+        entry = DELEGATIONS.get(zone)
+        if entry is not None:
+            if entry[0] > now:
+                return zone, entry[1]
+            del DELEGATIONS[zone]
+    return '', None
+
+
+def zone_servers(zone: str, ns_names: list, depth: int) -> list:
+    '''Addresses of the name servers of a zone, resolving the ones without glue'''
+    if ns_names is None:
+        return ROOT_HINTS
+    addresses = []
+    for ns_name in ns_names:
+        addresses.extend(glue_get(ns_name) or [])
+    for ns_name in ns_names:
+        if addresses:
+            break
+        if in_zone(ns_name, zone):
+            continue
+        try:
+            rcode, answers = iterate(DNS_TYPES['A'], ns_name, depth + 1)
+        except (OSError, ValueError):
+            continue
+        if answers:
+            GLUE[ns_name] = (time.time() + min(answer[1] for answer in answers), [answer[2] for answer in answers])
+            addresses.extend(answer[2] for answer in answers)
+    if not addresses:
+        raise ValueError('No address for the name servers of {}'.format(zone or 'the root'))
+    return addresses
+
+
+def store_referral(message: dict, zone: str, name: str) -> str:
+    '''Cache the delegation a referral points to, returning the child zone or None if it is not a referral'''
+
+    '''
+        A referral carries the NS records of a zone below the one just asked, on the way to the name, in its authority section, and usually the addresses of those name servers (glue) in its additional section. Glue is only trusted for name servers inside the zone that was asked, which could have served those addresses itself.
+    '''
+
+    records = [record for record in message['authority'] if record[1] == DNS_TYPES['NS']]
+    if not records:
+        return None
+    child = records[0][0].lower()
+    if child == zone or not in_zone(child, zone) or not in_zone(name, child):
+        raise ValueError('Bad referral to {} from {}'.format(child or 'the root', zone or 'the root'))
+
+    records = [record for record in records if record[0].lower() == child]
+    ns_names = [record[4].lower() for record in records]
+    glue = dict()
+    for r_name, r_type, _, ttl, address in message['additional']:
+        r_name = r_name.lower()
+        if r_type == DNS_TYPES['A'] and r_name in ns_names and in_zone(r_name, zone):
+            glue_ttl, addresses = glue.get(r_name, (ttl, []))
+            glue[r_name] = (min(ttl, glue_ttl), addresses + [address])
+    delegation_put(child, ns_names, glue, min(record[3] for record in records))
+    return child
+
+
+def ask_zone(q_type: int, name: str, zone: str, servers: list) -> tuple:
+    '''Query the name servers of a zone, returning (rcode, canonical name, answers, child zone or None)'''
+
+    '''
+        The child zone is the one a referral points to, already cached by store_referral. A server whose response is malformed or whose referral goes up or sideways (a lame delegation) counts a failure, and the query goes on with the other servers of the zone.
+    '''
+
+    q_message = encode_query(q_type, name.split('.'), recursion=False, payload_size=EDNS_PAYLOAD)
+    while True:
+        response_bytes, q_server = query_servers(q_message, servers)
+        try:
+            message = parse_message(response_bytes)
+            canonical, answers = follow_cnames(message['answers'], q_type, name)
+            child = None
+            if message['rcode'] == RCODE_NOERROR and not answers and canonical == name:
+                child = store_referral(message, zone, name)
+            return message['rcode'], canonical, answers, child
+        except ValueError:
+            record_failure(q_server)
+            servers = [server for server in servers if server != q_server]
+            if not servers:
+                raise
+
+
+def iterate(q_type: int, name: str, depth: int = 0) -> tuple:
+    '''Resolve a name by following referrals from the closest known delegation, returning (rcode, answers)'''
+    if depth > MAX_DEPTH:
+        raise ValueError('Too many levels of indirection resolving {}'.format(name))
+
+    for _ in range(MAX_REFERRALS):
+        zone, ns_names = closest_delegation(name)
+        rcode, canonical, answers, child = ask_zone(q_type, name, zone, rank_servers(zone_servers(zone, ns_names, depth)))
+        if rcode != RCODE_NOERROR:
+            return rcode, []
+        if answers:
+            return RCODE_NOERROR, answers
+        if canonical != name:
+            return iterate(q_type, canonical, depth + 1)
+        if child is None:
+            return RCODE_NOERROR, []
+    raise ValueError('Too many referrals resolving {}'.format(name))
+
+
+def iterative_lookup(q_type: int, q_domain: list) -> list:
+    '''Answer a query from the cache, or by iterating from the root servers on a miss'''
+
+    '''
+        iterative_lookup does not rely on a recursive server: it asks the root servers (ROOT_HINTS) without the RD bit, follows the referrals down to the servers authoritative for the name, and returns a list of (domain, ttl, address) tuples like lookup. Referrals are cached in DELEGATIONS and GLUE, apart from the answers, so later queries under a known zone start from its name servers.
+    '''
+
+    cached = cached_answers(q_type, q_domain)
+    if cached is not None:
+        return cached[1]
+    rcode, answers = iterate(q_type, '.'.join(q_domain).lower())
+    if rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        store_answers(q_type, q_domain, answers, rcode)
+    return answers
+
+
+class QueryProtocol(asyncio.DatagramProtocol):
+    '''UDP endpoint dispatching responses to the queries waiting for them'''
+
+    '''
+        Outstanding queries are keyed by a random transaction id that is unique on this socket. A response is handed over only if it comes from the server the query was sent to and match_response accepts it; anything else is counted in rejected and dropped, so stray or spoofed packets cannot complete a query.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.pending = dict()
+        self.rejected = 0
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def submit(self, q_type: int, q_domain: list, addr: tuple, payload_size: int = EDNS_PAYLOAD) -> tuple:
+        '''Send a query, returning its transaction id and a future for the response'''
+        trans_id = randbits(16)
+        while trans_id in self.pending:
+            trans_id = randbits(16)
+        q_message = encode_query(q_type, q_domain, trans_id, payload_size=payload_size)
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending[trans_id] = (q_message, addr, waiter)
+        self.transport.sendto(q_message, addr)
+        return trans_id, waiter
+
+    def cancel(self, trans_id: int) -> None:
+        '''Forget an outstanding query'''
+        self.pending.pop(trans_id, None)
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        entry = self.pending.get(bytes_to_val(data[0:2])) if len(data) >= 12 else None
+        if entry is None or entry[1] != addr[:2] or not match_response(entry[0], data):
+            self.rejected += 1
+            return
+        del self.pending[bytes_to_val(data[0:2])]
+        if not entry[2].done():
+            entry[2].set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        for _, _, waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.pending.clear()
+
+
+async def open_pool(n_sockets: int = BULK_SOCKETS) -> list:
+    '''Open a pool of UDP sockets for asynchronous queries'''
+    loop = asyncio.get_running_loop()
+    pool = []
+    for _ in range(n_sockets):
+        transport, protocol = await loop.create_datagram_endpoint(QueryProtocol, family=AF_INET)
+        pool.append((transport, protocol))
+    return pool
+
+
+def close_pool(pool: list) -> None:
+    '''Close the sockets of a pool'''
+    for transport, _ in pool:
+        transport.close()
+
+
+async def race_request_async(pool: list, q_type: int, q_domain: list, q_servers: list, timeout: float,
+                             payload_size: int = EDNS_PAYLOAD) -> tuple:
+    '''Asynchronous race_request, sending the queries over the least busy sockets of the pool'''
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    submitted = dict()
+    for q_server in q_servers:
+        _, protocol = min(pool, key=lambda endpoint: len(endpoint[1].pending))
+        trans_id, waiter = protocol.submit(q_type, q_domain, (q_server, PORT), payload_size)
+        submitted[waiter] = (protocol, trans_id, q_server)
+
+    error_response = None
+    error = None
+    pending = set(submitted)
+    deadline = loop.time() + timeout
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for waiter in done:
+                q_server = submitted[waiter][2]
+                if waiter.exception() is not None:
+                    record_failure(q_server)
+                    error = waiter.exception()
+                    continue
+                resp_bytes = waiter.result()
+                if is_server_error(resp_bytes):
+                    record_failure(q_server)
+                    error_response = (resp_bytes, q_server)
+                    continue
+                rtt = time.monotonic() - start
+                record_rtt(q_server, rtt)
+                for other in pending:
+                    record_lost(submitted[other][2], rtt)
+                return resp_bytes, q_server
+    finally:
+        for protocol, trans_id, _ in submitted.values():
+            protocol.cancel(trans_id)
+
+    for waiter in pending:
+        record_failure(submitted[waiter][2])
+    if error_response is not None:
+        return error_response
+    if error is not None and not pending:
+        raise error
+    raise asyncio.TimeoutError()
+
+
+async def query_servers_async(pool: list, q_type: int, q_domain: list, servers: list, race: int = None) -> bytes:
+    '''Asynchronous query_servers'''
+    race = RACE if race is None else race
+    payload_size = EDNS_PAYLOAD
+    response = None
+    error = None
+    for attempt in range(ATTEMPTS):
+        try:
+            resp_bytes, q_server = await race_request_async(pool, q_type, q_domain, attempt_servers(servers, attempt, race),
+                                                            attempt_timeout(attempt), payload_size)
+            if get_rcode(resp_bytes) in (RCODE_FORMERR, RCODE_NOTIMP) and payload_size is not None:
+                payload_size = None
+                resp_bytes, q_server = await race_request_async(pool, q_type, q_domain, [q_server],
+                                                                attempt_timeout(attempt), payload_size)
+            if is_truncated(resp_bytes):
+                q_message = encode_query(q_type, q_domain, payload_size=payload_size)
+                resp_bytes = await asyncio.get_running_loop().run_in_executor(
+                    None, send_request_tcp, q_message, q_server, attempt_timeout(attempt))
+        except (asyncio.TimeoutError, OSError) as e:
+            error = e
+            continue
+        if is_server_error(resp_bytes):
+            response = resp_bytes
+            continue
+        return resp_bytes
+    if response is not None:
+        return response
+    raise error
+
+
+async def lookup_async(pool: list, q_type: int, q_domain: list, q_server: str, failover: bool = True) -> tuple:
+    '''Asynchronous lookup, answering from the cache when possible and returning the response code and the answers'''
+
+    '''
+        Concurrent lookups of the same name and type share one upstream query: the first one starts it and the others wait for its answers (or its error), so a burst of identical queries, e.g. when a popular entry expires, sends a single packet. The shared query is shielded, so a caller that gives up does not cancel it for the others.
+
+        An entry hit PREFETCH_HITS times is refreshed in the background once less than PREFETCH_RATIO of its TTL remains, so popular names do not expire in front of clients. With serve-stale, a lookup of an expired name returns the stale answers if the servers fail or take more than STALE_TIMEOUT seconds; the query goes on and refreshes the cache.
+    '''
+
+    cached = cached_answers(q_type, q_domain)
+    if cached is not None:
+        if prefetch_due(q_type, q_domain) and cache_key(q_type, q_domain) not in IN_FLIGHT:
+            CACHE_STATS['prefetches'] += 1
+            fetch_shared(pool, q_type, q_domain, q_server, failover)
+        return cached
+
+    task = fetch_shared(pool, q_type, q_domain, q_server, failover)
+    stale = stale_answers(q_type, q_domain)
+    if stale is None:
+        return await asyncio.shield(task)
+    try:
+        rcode, answers = await asyncio.wait_for(asyncio.shield(task), STALE_TIMEOUT)
+    except (asyncio.TimeoutError, OSError, ValueError):
+        rcode = None
+    if rcode in (None, RCODE_SERVFAIL, RCODE_REFUSED):
+        CACHE_STATS['stale'] += 1
+        return stale
+    return rcode, answers
+
+
+def fetch_shared(pool: list, q_type: int, q_domain: list, q_server: str, failover: bool) -> asyncio.Task:
+    '''Get the upstream query in flight for a name and type, starting one if there is none'''
+    key = cache_key(q_type, q_domain)
+    task = IN_FLIGHT.get(key)
+    if task is not None:
+        CACHE_STATS['coalesced'] += 1
+        return task
+
+    def done(task):
+        IN_FLIGHT.pop(key, None)
+        if not task.cancelled():
+            # Nobody may be waiting for a prefetch; if it failed, the entry simply expires
+            task.exception()
+
+    task = asyncio.ensure_future(fetch_async(pool, q_type, q_domain, candidate_servers(q_server, failover)))
+    IN_FLIGHT[key] = task
+    task.add_done_callback(done)
+    return task
+
+
+async def fetch_async(pool: list, q_type: int, q_domain: list, servers: list) -> tuple:
+    '''Query the servers and cache the answers, returning the response code and the answers'''
+    response_bytes = await query_servers_async(pool, q_type, q_domain, servers)
+    return get_rcode(response_bytes), store_response(q_type, q_domain, response_bytes)
+
+
+async def read_lines(lines, buffered: int = BULK_CONCURRENCY):
+    '''Read lines from a file (or any iterable) in a separate thread, so waiting on slow input does not block the event loop'''
+
+    '''
+        At most buffered lines are read ahead of the consumer. The thread is a daemon, so a process interrupted while it waits for input, e.g. on a pipe from tail -f, still exits.
+    '''
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    slots = threading.Semaphore(buffered)
+
+    def put(item: tuple) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The loop is closed; nobody is reading anymore
+            pass
+
+    def read() -> None:
+        try:
+            for line in lines:
+                slots.acquire()
+                put((line, None))
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        line, error = await queue.get()
+        if error is not None:
+            raise error
+        if line is None:
+            return
+        slots.release()
+        yield line
+
+
+async def stream_tasks(lines, start, concurrency: int, ordered: bool = False):
+    '''Run start(line) as a task for every non-blank line, at most concurrency at a time, yielding the results as soon as they are ready'''
+
+    '''
+        Results come in completion order, or in input order if ordered, where a result finished ahead of an earlier one waits for it. Lines are read (with read_lines) while the tasks run, so slow input holds up neither the queries nor the results already finished.
+    '''
+
+    lines = read_lines(lines)
+    tasks = deque()
+    reading = asyncio.ensure_future(anext(lines))
+    try:
+        while reading is not None or tasks:
+            waiting = {tasks[0]} if ordered and tasks else set(tasks)
+            if reading is not None and len(tasks) < concurrency:
+                waiting.add(reading)
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if reading is not None and reading.done():
+                try:
+                    line = reading.result().strip()
+                except StopAsyncIteration:
+                    reading = None
+                else:
+                    reading = asyncio.ensure_future(anext(lines))
+                    if line:
+                        tasks.append(asyncio.ensure_future(start(line)))
+            if ordered:
+                while tasks and tasks[0].done():
+                    yield tasks.popleft().result()
+            else:
+                for task in [task for task in tasks if task.done()]:
+                    tasks.remove(task)
+                    yield task.result()
+    finally:
+        if reading is not None:
+            reading.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def resolve_bulk(names, q_type: str, q_server: str = None, concurrency: int = BULK_CONCURRENCY,
+                       n_sockets: int = BULK_SOCKETS):
+    '''Resolve many names concurrently, yielding results as they arrive'''
+
+    '''
+        resolve_bulk reads names lazily in a separate thread, keeps at most concurrency queries in flight over a pool of n_sockets UDP sockets, and yields (name, answers, error) tuples in completion order. error is None on success; a failed name does not stop the others. Without q_server, queries fail over across PUBLIC_DNS_SERVER.
+    '''
+
+    async def resolve_one(name: str) -> tuple:
+        try:
+            num_type, q_domain, server = parse_cli_query('resolver.py', q_type, name, q_server)
+            _, answers = await lookup_async(pool, num_type, q_domain, server, failover=q_server is None)
+            return name, answers, None
+        except asyncio.TimeoutError:
+            return name, [], 'timed out'
+        except (OSError, ValueError, IndexError) as e:
+            return name, [], str(e) or type(e).__name__
+
+    pool = await open_pool(n_sockets)
+    results = stream_tasks(names, resolve_one, concurrency)
+    try:
+        async for result in results:
+            yield result
+    finally:
+        await results.aclose()
+        close_pool(pool)
+
+
+async def print_bulk(names, q_type: str, q_server: str = None) -> None:
+    '''Resolve names in bulk and print one line per name'''
+    async for name, answers, error in resolve_bulk(names, q_type, q_server):
+        if error is not None:
+            print('{}\tERROR: {}'.format(name, error))
+        elif not answers:
+            print('{}\tNOT FOUND'.format(name))
+        else:
+            print('{}\t{}'.format(name, ' '.join(str(a[2]) for a in answers)))
+
+
+async def resolve_address(pool: list, address: str, q_server: str = None) -> tuple:
+    '''Look up the host names of an address, returning (address, names, error)'''
+    try:
+        q_domain = reverse_name(address)
+        server = choice(PUBLIC_DNS_SERVER) if q_server is None else q_server
+        _, answers = await lookup_async(pool, DNS_TYPES['PTR'], q_domain, server, failover=q_server is None)
+        return address, [answer[2] for answer in answers], None
+    except asyncio.TimeoutError:
+        return address, [], 'timed out'
+    except (OSError, ValueError) as e:
+        return address, [], str(e) or type(e).__name__
+
+
+async def resolve_reverse(addresses, q_server: str = None, concurrency: int = BULK_CONCURRENCY,
+                          n_sockets: int = BULK_SOCKETS):
+    '''Look up the host names of many addresses concurrently, yielding results in input order'''
+
+    '''
+        resolve_reverse reads IPv4 and IPv6 addresses lazily in a separate thread and yields (address, names, error) tuples in the order they were read; error is None on success. At most concurrency lookups are in flight, and results finished ahead of an earlier one wait in the same window, so memory stays bounded however long the input is. Repeated addresses are answered from the cache, or share the lookup in flight.
+    '''
+
+    pool = await open_pool(n_sockets)
+    results = stream_tasks(addresses, lambda address: resolve_address(pool, address, q_server), concurrency, ordered=True)
+    try:
+        async for result in results:
+            yield result
+    finally:
+        await results.aclose()
+        close_pool(pool)
+
+
+async def print_reverse(addresses, q_server: str = None) -> None:
+    '''Look up addresses in bulk and print one line per address, in input order'''
+    async for address, names, error in resolve_reverse(addresses, q_server):
+        if error is not None:
+            print('{}\tERROR: {}'.format(address, error))
+        elif not names:
+            print('{}\tNOT FOUND'.format(address))
+        else:
+            print('{}\t{}'.format(address, ' '.join(names)))
+
+
+def encode_rdata(r_type: int, data: str) -> bytes:
+    '''Encode the data of a record as decoded by parse_rdata back to the wire format, raising ValueError if it does not fit its type'''
+    if r_type in (DNS_TYPES['A'], DNS_TYPES['AAAA']):
+        try:
+            return inet_pton(AF_INET if r_type == DNS_TYPES['A'] else AF_INET6, data)
+        except OSError:
+            raise ValueError('Not an address: {}'.format(data)) from None
+    if r_type in NAME_TYPES:
+        return encode_qname(data.split('.') if data else [])
+    if r_type == DNS_TYPES['MX']:
+        preference, exchange = data.split(' ', 1)
+        return bytes(val_to_2_bytes(int(preference))) + encode_qname(exchange.split('.') if exchange else [])
+    if r_type == SOA_TYPE:
+        mname, rname, *fields = data.split(' ')
+        try:
+            counters = SOA_FIELDS.pack(*map(int, fields))
+        except struct.error as e:
+            raise ValueError('Bad SOA record: {}'.format(e)) from None
+        return encode_qname(mname.split('.') if mname else []) + encode_qname(rname.split('.') if rname else []) + counters
+    if r_type == DNS_TYPES['TXT']:
+        text = data.encode('utf-8')
+        chunks = [text[i:i + 255] for i in range(0, len(text), 255)] or [b'']
+        return b''.join(bytes([len(chunk)]) + chunk for chunk in chunks)
+    return bytes.fromhex(data)
+
+
+def encodable(r_type: int, answers: list) -> bool:
+    '''Check that the daemon can send (domain, ttl, data) answers back to its clients'''
+    try:
+        for _, _, data in answers:
+            encode_rdata(r_type, data)
+    except ValueError:
+        return False
+    return True
+
+
+def format_response(q_message: bytes, question: tuple, answers: list = (), rcode: int = RCODE_NOERROR,
+                    payload_size: int = None, max_size: int = None) -> bytes:
+    '''Build the response to a query from (domain, ttl, data) answers'''
+
+    '''
+        The answers of a CNAME chain are owned by the canonical name, so a CNAME record from the queried name to it is put first, as clients only accept answers for the name they asked. payload_size is the size advertised by the client in its OPT record, None if it sent none; the response then carries an OPT record too. A response longer than max_size, by default what the client accepts over UDP, is sent without answers and with the TC bit set, so the client retries over TCP.
+    '''
+
+    q_name, q_type, _ = question
+    records = []
+    if answers and answers[0][0].lower() != q_name.lower():
+        records.append((q_name, DNS_TYPES['CNAME'], min(a[1] for a in answers), answers[0][0]))
+    records.extend((domain, q_type, ttl, data) for domain, ttl, data in answers)
+
+    with memoryview(q_message) as msg:
+        _, q_end = parse_question(msg, HEADER.size)
+    flags = 0x8080 | (bytes_to_val(q_message[2:4]) & 0x0100) | rcode
+    body = bytearray(q_message[HEADER.size:q_end])
+    for domain, r_type, ttl, data in records:
+        rdata = encode_rdata(r_type, data)
+        body.extend(encode_qname(domain.split('.') if domain else []))
+        body.extend(RR_HEADER.pack(r_type, 1, ttl, len(rdata)))
+        body.extend(rdata)
+    trans_id = bytes_to_val(q_message[0:2])
+    opt = b'' if payload_size is None else format_opt(EDNS_PAYLOAD)
+    arcount = 0 if payload_size is None else 1
+    max_size = max(payload_size or 0, UDP_PAYLOAD) if max_size is None else max_size
+    if HEADER.size + len(body) + len(opt) > max_size:
+        return HEADER.pack(trans_id, flags | 0x0200, 1, 0, 0, arcount) + q_message[HEADER.size:q_end] + opt
+    return HEADER.pack(trans_id, flags, 1, len(records), 0, arcount) + bytes(body) + opt
+
+
+def parse_query(q_message: bytes) -> tuple:
+    '''Check a query received by the daemon, returning its question and the UDP payload size from its OPT record'''
+    message = parse_message(q_message)
+    if message['flags'] & 0x8000 or message['qdcount'] != 1:
+        raise ValueError('Not a query with one question')
+    if message['flags'] & 0x7800:
+        raise NotImplementedError('Unsupported opcode')
+    question = message['questions'][0]
+    if question[2] != 1:
+        raise NotImplementedError('Unsupported class')
+    opt = [record for record in message['additional'] if record[1] == OPT_TYPE]
+    return question, opt[0][2] if opt else None
+
+
+def answer_cached(q_message: bytes, max_size: int = None) -> bytes:
+    '''Answer a query from the cache, or return None if it has to go upstream'''
+    try:
+        question, payload_size = parse_query(q_message)
+    except NotImplementedError:
+        return format_error(q_message, RCODE_NOTIMP)
+    except ValueError:
+        return format_error(q_message, RCODE_FORMERR)
+    cached = cached_answers(question[1], question[0].split('.') if question[0] else [])
+    if cached is None:
+        return None
+    rcode, answers = cached
+    try:
+        return format_response(q_message, question, answers, rcode, payload_size, max_size)
+    except ValueError:
+        return format_error(q_message, RCODE_SERVFAIL)
+
+
+def format_error(q_message: bytes, rcode: int) -> bytes:
+    '''Build an error response echoing the query header'''
+    flags = 0x8080 | (bytes_to_val(q_message[2:4]) & 0x7900) | rcode
+    return HEADER.pack(bytes_to_val(q_message[0:2]), flags, 0, 0, 0, 0)
+
+
+async def answer_upstream(pool: list, q_message: bytes, q_server: str = None, max_size: int = None) -> bytes:
+    '''Answer a query by forwarding it upstream and caching the answers'''
+    question, payload_size = parse_query(q_message)
+    server = choice(PUBLIC_DNS_SERVER) if q_server is None else q_server
+    try:
+        rcode, answers = await lookup_async(pool, question[1], question[0].split('.') if question[0] else [], server, failover=q_server is None)
+    except (asyncio.TimeoutError, OSError, ValueError):
+        return format_error(q_message, RCODE_SERVFAIL)
+    try:
+        return format_response(q_message, question, answers, rcode, payload_size, max_size)
+    except ValueError:
+        return format_error(q_message, RCODE_SERVFAIL)
+
+
+class DaemonProtocol(asyncio.DatagramProtocol):
+    '''Listener answering DNS queries from the cache, forwarding misses upstream'''
+
+    '''
+        The TCP listener on the same port (server) hands its connections to serve_stream, so clients that get a truncated response over UDP can retry over TCP. Closing the UDP transport closes it too.
+    '''
+
+    def __init__(self, pool: list, q_server: str = None):
+        self.pool = pool
+        self.q_server = q_server
+        self.transport = None
+        self.server = None
+        self.tasks = set()
+        self.streams = set()
+        self.stats = {'queries': 0, 'cached': 0, 'forwarded': 0}
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        if len(data) < HEADER.size or data[2] & 0x80:
+            return
+        self.stats['queries'] += 1
+        response = answer_cached(data)
+        if response is not None:
+            self.stats['cached'] += 1
+            self.transport.sendto(response, addr)
+            return
+        self.stats['forwarded'] += 1
+        task = asyncio.ensure_future(self.forward(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def forward(self, data: bytes, addr: tuple) -> None:
+        response = await answer_upstream(self.pool, data, self.q_server)
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+    async def serve_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Answer the queries of a TCP connection, each prefixed with its length on 2 bytes, until it is closed or idle'''
+        self.streams.add(writer)
+        try:
+            while True:
+                length = await asyncio.wait_for(reader.readexactly(TCP_LENGTH.size), TCP_IDLE_TIMEOUT)
+                data = await reader.readexactly(TCP_LENGTH.unpack(length)[0])
+                if len(data) < HEADER.size or data[2] & 0x80:
+                    return
+                self.stats['queries'] += 1
+                response = answer_cached(data, TCP_PAYLOAD)
+                if response is not None:
+                    self.stats['cached'] += 1
+                else:
+                    self.stats['forwarded'] += 1
+                    response = await answer_upstream(self.pool, data, self.q_server, TCP_PAYLOAD)
+                writer.write(TCP_LENGTH.pack(len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.streams.discard(writer)
+            writer.close()
+
+    def connection_lost(self, exc: Exception) -> None:
+        if self.server is not None:
+            self.server.close()
+        for writer in self.streams:
+            writer.close()
+        for task in self.tasks:
+            task.cancel()
+
+
+async def open_daemon(host: str = DAEMON_HOST, port: int = DAEMON_PORT, q_server: str = None) -> tuple:
+    '''Start listening for DNS queries over UDP and TCP, returning the UDP transport, the protocol and the upstream pool'''
+    pool = await open_pool()
+    try:
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: DaemonProtocol(pool, q_server), local_addr=(host, port))
+    except OSError:
+        close_pool(pool)
+        raise
+    try:
+        protocol.server = await asyncio.start_server(protocol.serve_stream, host, transport.get_extra_info('sockname')[1])
+    except OSError:
+        transport.close()
+        close_pool(pool)
+        raise
+    return transport, protocol, pool
+
+
+async def serve_daemon(host: str = DAEMON_HOST, port: int = DAEMON_PORT, q_server: str = None) -> None:
+    '''Answer DNS queries until cancelled'''
+
+    '''
+        The daemon is a caching forwarder listening on one port over UDP and TCP: a query is answered from the cache (the in-process one, then CACHE_DB) when possible, and otherwise forwarded to q_server, or to PUBLIC_DNS_SERVER with failover. Upstream failures are answered with SERVFAIL and malformed queries with FORMERR.
+    '''
+
+    transport, protocol, pool = await open_daemon(host, port, q_server)
+    print('Listening on {}:{} (UDP and TCP), forwarding to {}'.format(host, port, q_server or 'public servers'))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        close_pool(pool)
+        print('Answered {queries} queries, {cached} from the cache, {forwarded} forwarded'.format(**protocol.stats))
+        print(format_cache_stats())
+
+
 def resolve(query: str) -> None:
     '''Resolve the query'''
 
@@ -387,23 +1925,117 @@ def resolve(query: str) -> None:
     '''
 
     q_type, q_domain, q_server = parse_cli_query(*query[0])
-    query_bytes = format_query(q_type, q_domain)
-    response_bytes = send_request(query_bytes, q_server)
-    answers = parse_response(response_bytes)
+    failover = len(query[0]) < 4
+    try:
+        answers, q_server = lookup(q_type, q_domain, q_server, failover)
+    except OSError as e:
+        print('No response from {}: {}'.format('the public servers' if failover else q_server, e))
+        return
+    except ValueError as e:
+        print('Malformed response: {}'.format(e))
+        return
     print('DNS server used: {}'.format(q_server))
+    print_answers(query[0][1], answers)
+
+
+def print_answers(q_type: str, answers: list) -> None:
+    '''Print answers, one field per line'''
+    label = 'Address' if q_type in ('A', 'AAAA') else q_type
     for a in answers:
         print('Domain: {}'.format(a[0]))
         print('TTL: {}'.format(a[1]))
-        print('Address: {}'.format(a[2]))
+        print('{}: {}'.format(label, a[2]))
 
 
 def main(*query):
     '''Main function'''
+    global CACHE_DB
+    if CACHE_FILE:
+        try:
+            CACHE_DB = open_cache_file(CACHE_FILE)
+        except (sqlite3.Error, OSError) as e:
+            print('Cannot open the cache file {}, continuing without it: {}'.format(CACHE_FILE, e), file=sys.stderr)
+            CACHE_DB = None
+    if len(query[0]) > 1 and query[0][1] == '--bulk':
+        bulk(query[0][2:])
+        return
+    if len(query[0]) > 1 and query[0][1] == '--iterative':
+        iterative(query[0][2:])
+        return
+    if len(query[0]) > 1 and query[0][1] == '--daemon':
+        daemon(query[0][2:])
+        return
+    if len(query[0]) > 1 and query[0][1] == '--reverse':
+        reverse(query[0][2:])
+        return
     if len(query[0]) < 3 or len(query[0]) > 4:
         print('Proper use: python3 resolver.py <type> <domain> <server>')
+        print('            python3 resolver.py --bulk <type> [<file>|-] [<server>]')
+        print('            python3 resolver.py --iterative <type> <domain>')
+        print('            python3 resolver.py --daemon [<port>] [<server>]')
+        print('            python3 resolver.py --reverse [<file>|-] [<server>]')
         exit()
     resolve(query)
 
 
+def bulk(args: list) -> None:
+    '''Bulk mode: resolve the names listed in a file (or stdin), one per line'''
+    if len(args) < 1 or len(args) > 3:
+        print('Proper use: python3 resolver.py --bulk <type> [<file>|-] [<server>]')
+        exit()
+    q_type = args[0]
+    filename = args[1] if len(args) > 1 else '-'
+    q_server = args[2] if len(args) > 2 else None
+    if filename == '-':
+        asyncio.run(print_bulk(sys.stdin, q_type, q_server))
+    else:
+        with open(filename) as f:
+            asyncio.run(print_bulk(f, q_type, q_server))
+    print(format_cache_stats(), file=sys.stderr)
+
+
+def reverse(args: list) -> None:
+    '''Reverse mode: look up the host names of the addresses listed in a file (or stdin), one per line'''
+    if len(args) > 2:
+        print('Proper use: python3 resolver.py --reverse [<file>|-] [<server>]')
+        exit()
+    filename = args[0] if args else '-'
+    q_server = args[1] if len(args) > 1 else None
+    if filename == '-':
+        asyncio.run(print_reverse(sys.stdin, q_server))
+    else:
+        with open(filename) as f:
+            asyncio.run(print_reverse(f, q_server))
+    print(format_cache_stats(), file=sys.stderr)
+
+
+def iterative(args: list) -> None:
+    '''Iterative mode: resolve a name from the root servers, without a recursive server'''
+    if len(args) != 2:
+        print('Proper use: python3 resolver.py --iterative <type> <domain>')
+        exit()
+    q_type, q_domain, _ = parse_cli_query('resolver.py', args[0], args[1], ROOT_HINTS[0])
+    try:
+        answers = iterative_lookup(q_type, q_domain)
+    except (OSError, ValueError) as e:
+        print('Could not resolve {}: {}'.format(args[1], e))
+        return
+    print('DNS server used: none (iterative)')
+    print_answers(args[0], answers)
+
+
+def daemon(args: list) -> None:
+    '''Daemon mode: answer DNS queries on a local UDP port until interrupted'''
+    if len(args) > 2 or (args and not args[0].isdigit()):
+        print('Proper use: python3 resolver.py --daemon [<port>] [<server>]')
+        exit()
+    port = int(args[0]) if args else DAEMON_PORT
+    q_server = args[1] if len(args) > 1 else None
+    try:
+        asyncio.run(serve_daemon(DAEMON_HOST, port, q_server))
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,47 @@
+'''
+DNS query encoder benchmark
+'''
+#!/usr/bin/env python3
+
+import argparse
+import timeit
+
+from resolver import format_query, encode_query, encode_query_into, EDNS_PAYLOAD, QUERY_BUFFER, QNAMES
+
+
+def make_names(n_names: int) -> list:
+    '''Build distinct domain names, as lists of labels'''
+    return [['host{}'.format(i), 'example', 'com'] for i in range(n_names)]
+
+
+def bench(label: str, encode, names: list, repeat: int) -> float:
+    '''Time encoding every name, returning the best time per query in seconds'''
+    best = min(timeit.repeat(lambda: [encode(q_domain) for q_domain in names], number=1, repeat=repeat))
+    per_query = best / len(names)
+    print('{:<18} {:>8.0f} ns/query {:>12,.0f} queries/s'.format(label, per_query * 1e9, 1 / per_query))
+    return per_query
+
+
+def main():
+    '''Main function'''
+    parser = argparse.ArgumentParser(description='DNS query encoder benchmark')
+    parser.add_argument('--names', type=int, default=1000, help='distinct names')
+    parser.add_argument('--queries', type=int, default=100000, help='queries per run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best one is kept')
+    args = parser.parse_args()
+
+    names = make_names(args.names) * max(1, args.queries // args.names)
+    print('Encoding {} queries over {} names, best of {}'.format(len(names), args.names, args.repeat))
+    baseline = bench('format_query', lambda q_domain: format_query(1, q_domain, 0x4f42, payload_size=EDNS_PAYLOAD),
+                     names, args.repeat)
+    QNAMES.clear()
+    fast = bench('encode_query', lambda q_domain: encode_query(1, q_domain, 0x4f42, payload_size=EDNS_PAYLOAD),
+                 names, args.repeat)
+    into = bench('encode_query_into',
+                 lambda q_domain: encode_query_into(QUERY_BUFFER, 1, q_domain, 0x4f42, payload_size=EDNS_PAYLOAD),
+                 names, args.repeat)
+    print('Speedup: {:.1f}x (encode_query), {:.1f}x (encode_query_into)'.format(baseline / fast, baseline / into))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,11 @@ Testing the DNS resolver
 #!/usr/bin/python3
 
 
+import asyncio
+import threading
+import time
 from random import seed
+from socket import socket, SOCK_DGRAM, SOCK_STREAM, AF_INET, SHUT_RDWR
 import pytest
 from resolver import val_to_2_bytes
 from resolver import val_to_n_bytes
@@ -15,20 +19,131 @@ from resolver import parse_cli_query
 from resolver import format_query
 from resolver import parse_response
 from resolver import parse_answers
+from resolver import decode_name
+from resolver import parse_message
+from resolver import follow_cnames
+from resolver import iterative_lookup
+from resolver import send_request_tcp
+from resolver import encode_query
+from resolver import format_response
+from resolver import open_daemon
+from resolver import lookup_async
+from resolver import cache_get_stale
+from resolver import prefetch_due
+from resolver import reverse_name
+from resolver import resolve_reverse
 from resolver import parse_address_a
 from resolver import parse_address_aaaa
 from resolver import PUBLIC_DNS_SERVER
+from resolver import cache_get
+from resolver import cache_put
+from resolver import lookup
+from resolver import open_cache_file
+from resolver import disk_cache_get
+from resolver import disk_cache_put
+from resolver import resolve_bulk
+from resolver import get_question
+from resolver import match_response
+from resolver import record_rtt
+from resolver import record_failure
+from resolver import rank_servers
+from resolver import query_servers
+from resolver import server_score
+import resolver
 
 seed(430)
 
 
+def answer_a(request: bytes, address: bytes = b'\x7f\x00\x00\x01') -> bytes:
+    '''Answer a query with a single A record'''
+    return request[:2] + b'\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00' + request[12:request.index(b'\x00', 12) + 5] + \
+        b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04' + address
+
+
+def encode_name(name: str) -> bytes:
+    '''Encode a name as uncompressed labels'''
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.') if label) + b'\x00'
+
+
+def build_response(request: bytes, answers=(), authority=(), additional=(), rcode: int = 0) -> bytes:
+    '''Answer a query with the given (name, type, ttl, rdata) records'''
+    end = request.index(b'\x00', 12) + 5
+    sections = [answers, authority, additional]
+    header = request[:2] + bytes([0x84, 0x00 | rcode, 0, 1]) + b''.join(len(section).to_bytes(2, 'big') for section in sections)
+    records = b''.join(encode_name(name) + r_type.to_bytes(2, 'big') + b'\x00\x01' + ttl.to_bytes(4, 'big') +
+                       len(rdata).to_bytes(2, 'big') + rdata for section in sections for name, r_type, ttl, rdata in section)
+    return header + request[12:end] + records
+
+
+def start_udp_server(handler, host: str = '127.0.0.1', port: int = 0) -> tuple:
+    '''Run a stand-in DNS server answering each request with handler(request), or not at all if it returns None'''
+    sckt = socket(AF_INET, SOCK_DGRAM)
+    sckt.bind((host, port))
+    sckt.settimeout(0.05)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            try:
+                request, addr = sckt.recvfrom(2048)
+            except OSError:
+                continue
+            response = handler(request)
+            if response is not None:
+                sckt.sendto(response, addr)
+        sckt.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sckt.getsockname()[1], stop.set
+
+
+def start_tcp_server(handler, host: str = '127.0.0.1', port: int = 0) -> tuple:
+    '''Run a stand-in DNS server over TCP, returning its port, a list of the accepted connections and a stop function'''
+    sckt = socket(AF_INET, SOCK_STREAM)
+    sckt.bind((host, port))
+    sckt.listen()
+    sckt.settimeout(0.05)
+    stop = threading.Event()
+    accepted = []
+
+    def serve(conn):
+        with conn:
+            while True:
+                length = conn.recv(2)
+                if len(length) < 2:
+                    return
+                request = conn.recv(int.from_bytes(length, 'big'))
+                response = handler(request)
+                conn.sendall(len(response).to_bytes(2, 'big') + response)
+
+    def listen():
+        while not stop.is_set():
+            try:
+                conn, addr = sckt.accept()
+            except OSError:
+                continue
+            accepted.append(addr)
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+        sckt.close()
+
+    threading.Thread(target=listen, daemon=True).start()
+    return sckt.getsockname()[1], accepted, stop.set
+
+
 class TestResolver:
     '''Testing DNS resolver'''
 
     @pytest.fixture(scope='function', autouse=True)
     def setup_class(self):
         '''Setting up'''
-        pass
+        resolver.CACHE.clear()
+        resolver.SERVER_STATS.clear()
+        resolver.DELEGATIONS.clear()
+        resolver.GLUE.clear()
+        resolver.close_tcp_pool()
+        resolver.IN_FLIGHT.clear()
+        for counter in resolver.CACHE_STATS:
+            resolver.CACHE_STATS[counter] = 0
 
     def test_val_to_bytes(self):
         '''Convert a value to 2 bytes'''
@@ -60,14 +175,70 @@ class TestResolver:
         assert cli_query[0] == 28
         assert cli_query[1] == ['luther', 'edu']
         assert cli_query[2] in PUBLIC_DNS_SERVER
+        assert parse_cli_query('resolver.py', 'MX', 'luther.edu', '1.0.0.1') == (15, ['luther', 'edu'], '1.0.0.1')
+        assert parse_cli_query('resolver.py', 'TXT', 'luther.edu', '1.0.0.1')[0] == 16
         with pytest.raises(ValueError) as excinfo:
-            parse_cli_query('resolver.py', 'MX', 'luther.edu')
+            parse_cli_query('resolver.py', 'SRV', 'luther.edu')
         exception_msg = excinfo.value.args[0]
         assert exception_msg == 'Unknown query type'
 
+    def test_reverse_name(self):
+        '''Build in-addr.arpa and ip6.arpa names'''
+        assert reverse_name('192.0.2.1') == ['1', '2', '0', '192', 'in-addr', 'arpa']
+        assert reverse_name('2001:db8::1') == list('1' + '0' * 23 + '8bd01002') + ['ip6', 'arpa']
+        assert parse_cli_query('resolver.py', 'PTR', '192.0.2.1', '1.0.0.1') == \
+            (12, ['1', '2', '0', '192', 'in-addr', 'arpa'], '1.0.0.1')
+        assert parse_cli_query('resolver.py', 'PTR', '1.2.0.192.in-addr.arpa', '1.0.0.1')[1][-1] == 'arpa'
+        with pytest.raises(ValueError):
+            reverse_name('192.0.2.300')
+
     def test_format_query(self):
         '''Format a query'''
-        assert format_query(1, ['luther', 'edu']) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
+        assert format_query(1, ['luther', 'edu'], 0x4f42) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
+        queries = [format_query(1, ['luther', 'edu']) for _ in range(10)]
+        assert all(q[2:] == b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01' for q in queries)
+        assert len({q[:2] for q in queries}) > 1
+
+    def test_format_query_edns(self):
+        '''Advertise the UDP payload size in an OPT record'''
+        assert format_query(1, ['luther', 'edu'], 0x4f42, payload_size=1232) == \
+            b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01\x06luther\x03edu\x00\x00\x01\x00\x01' + \
+            b'\x00\x00\x29\x04\xd0\x00\x00\x00\x00\x00\x00'
+
+    def test_encode_query(self):
+        '''Encode the same bytes as format_query'''
+        for q_type, q_domain in [(1, ['luther', 'edu']), (28, ['www', 'luther', 'edu']), (15, ['luther', 'edu'])]:
+            for recursion in (True, False):
+                for payload_size in (None, 1232):
+                    assert encode_query(q_type, q_domain, 0x4f42, recursion, payload_size) == \
+                        format_query(q_type, q_domain, 0x4f42, recursion, payload_size)
+        assert encode_query(1, ['luther', 'edu'])[2:] == format_query(1, ['luther', 'edu'])[2:]
+        with pytest.raises(ValueError):
+            encode_query(1, ['a' * 64, 'edu'])
+        with pytest.raises(ValueError):
+            encode_query(1, ['a' * 63] * 4)
+
+    def test_encode_qname(self):
+        '''Cache encoded names by their labels, with the root as [] or ['']'''
+        assert resolver.encode_qname(['']) == resolver.encode_qname([]) == b'\x00'
+        assert resolver.encode_qname(['luther', 'edu', '']) == resolver.encode_qname(['luther', 'edu']) == b'\x06luther\x03edu\x00'
+        assert resolver.encode_qname(['a.b']) == b'\x03a.b\x00'
+        assert resolver.encode_qname(['a', 'b']) == b'\x01a\x01b\x00'
+        with pytest.raises(ValueError):
+            resolver.encode_qname(['luther', '', 'edu'])
+
+    def test_match_response(self):
+        '''Match responses to queries by transaction id and question'''
+        query = format_query(1, ['luther', 'edu'], 0xc744)
+        response = b'\xc7D\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01' + \
+                   b'\x00\x01\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04\xae\x81\x19\xaa'
+        assert get_question(response) == b'\x06luther\x03edu\x00\x00\x01\x00\x01'
+        assert match_response(query, response)
+        assert match_response(query, response.replace(b'luther', b'LUTHER'))
+        assert not match_response(format_query(1, ['luther', 'edu'], 0xc745), response)
+        assert not match_response(format_query(28, ['luther', 'edu'], 0xc744), response)
+        assert not match_response(query, query)
+        assert not match_response(query, response[:8])
 
     def test_parse_response(self):
         '''Parse the response'''
@@ -151,6 +322,74 @@ class TestResolver:
                                  ('yahoo.com', 1257, '2001:4998:58:1836:0:0:0:10')
                              ]
 
+    def test_decode_name(self):
+        '''Decode labels and compression pointers, rejecting loops'''
+        msg = b'\x00' * 12 + b'\x03www\x06luther\x03edu\x00' + b'\x04mail\xc0\x10' + b'\xc0\x0c'
+        assert decode_name(memoryview(msg), 12) == ('www.luther.edu', 28)
+        assert decode_name(memoryview(msg), 28) == ('mail.luther.edu', 35)
+        assert decode_name(memoryview(msg), 35) == ('www.luther.edu', 37)
+        with pytest.raises(ValueError):
+            decode_name(memoryview(b'\x00' * 12 + b'\xc0\x0c'), 12)
+        with pytest.raises(ValueError):
+            decode_name(memoryview(b'\x00' * 12 + b'\x01a\xc0\x0e\xc0\x0c'), 12)
+        with pytest.raises(ValueError):
+            decode_name(memoryview(b'\x00' * 12 + b'\x05ab'), 12)
+
+    def test_parse_message(self):
+        '''Parse every section of a response'''
+        message = parse_message(b'tH\x81\x80\x00\x01\x00\x01\x00\x03\x00\x01\x06luther\x03edu\x00\x00\x01\x00\x01' +
+                                b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04\xae\x81\x19\xaa\xc0\x0c\x00\x02\x00' +
+                                b'\x01\x00\x01Q\x80\x00\x10\x05dns-2\x07iastate\xc0\x13\xc0\x0c\x00\x02\x00\x01\x00' +
+                                b'\x01Q\x80\x00\n\x03dns\x03uni\xc0\x13\xc0\x0c\x00\x02\x00\x01\x00\x01Q\x80\x00\t' +
+                                b'\x06martin\xc0\x0c\xc0j\x00\x01\x00\x01\x00\x01Q\x80\x00\x04\xc0\xcb\xc4\x14')
+        assert message['id'] == 0x7448
+        assert message['rcode'] == 0
+        assert message['questions'] == [('luther.edu', 1, 1)]
+        assert message['answers'] == [('luther.edu', 1, 1, 300, '174.129.25.170')]
+        assert [record[:4] for record in message['authority']] == [('luther.edu', 2, 1, 86400)] * 3
+        assert message['additional'] == [('martin.luther.edu', 1, 1, 86400, '192.203.196.20')]
+        with pytest.raises(ValueError):
+            parse_message(b'tH\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01\xc0\x0c')
+
+    def test_parse_record_types(self):
+        '''Decode CNAME, MX, NS, TXT and PTR records'''
+        message = parse_message(b'\x12\x34\x81\x80\x00\x01\x00\x05\x00\x00\x00\x00\x03www\x06luther\x03edu\x00\x00\xff\x00\x01' +
+                                b'\xc0\x0c\x00\x05\x00\x01\x00\x00\x00\x3c\x00\x02\xc0\x10' +
+                                b'\xc0\x10\x00\x0f\x00\x01\x00\x00\x00\x3c\x00\x09\x00\x0a\x04mail\xc0\x10' +
+                                b'\xc0\x10\x00\x02\x00\x01\x00\x00\x00\x3c\x00\x06\x03dns\xc0\x10' +
+                                b'\xc0\x10\x00\x10\x00\x01\x00\x00\x00\x3c\x00\x0b\x05v=spf\x041 -a' +
+                                b'\xc0\x10\x00\x0c\x00\x01\x00\x00\x00\x3c\x00\x02\xc0\x0c')
+        assert [(record[1], record[4]) for record in message['answers']] == [
+            (5, 'luther.edu'), (15, '10 mail.luther.edu'), (2, 'dns.luther.edu'), (16, 'v=spf1 -a'), (12, 'www.luther.edu')]
+
+    def test_parse_soa(self):
+        '''Decode the names of an SOA record through compression pointers, so it can be relayed on its own'''
+        soa = b'\x02ns\xc0\x0c\x05admin\xc0\x0c' + (2024010101).to_bytes(4, 'big') + bytes(12) + (60).to_bytes(4, 'big')
+        message = parse_message(b'\x12\x34\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x06\x00\x01' +
+                                b'\xc0\x0c\x00\x06\x00\x01\x00\x00\x0e\x10' + len(soa).to_bytes(2, 'big') + soa)
+        data = 'ns.luther.edu admin.luther.edu 2024010101 0 0 0 60'
+        assert message['answers'] == [('luther.edu', 6, 1, 3600, data)]
+        query = format_query(6, ['luther', 'edu'])
+        relayed = parse_message(format_response(query, ('luther.edu', 6, 1), [('luther.edu', 3600, data)]))
+        assert relayed['answers'] == message['answers']
+        with pytest.raises(ValueError):
+            parse_message(b'\x12\x34\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x06\x00\x01' +
+                          b'\xc0\x0c\x00\x06\x00\x01\x00\x00\x0e\x10' + (len(soa) - 4).to_bytes(2, 'big') + soa[:-4])
+
+    def test_follow_cnames(self):
+        '''Follow a CNAME chain to the records of the queried type'''
+        records = [('www.luther.edu', 5, 1, 600, 'web.luther.edu'),
+                   ('web.luther.edu', 5, 1, 60, 'cdn.example.net'),
+                   ('cdn.example.net', 1, 1, 300, '10.0.0.1'),
+                   ('cdn.example.net', 1, 1, 30, '10.0.0.2'),
+                   ('other.example.net', 1, 1, 300, '10.0.0.3')]
+        assert follow_cnames(records, 1, 'WWW.luther.edu') == \
+            ('cdn.example.net', [('cdn.example.net', 60, '10.0.0.1'), ('cdn.example.net', 30, '10.0.0.2')])
+        assert follow_cnames(records, 28, 'www.luther.edu') == ('cdn.example.net', [])
+        assert follow_cnames(records, 5, 'www.luther.edu') == ('www.luther.edu', [('www.luther.edu', 600, 'web.luther.edu')])
+        with pytest.raises(ValueError):
+            follow_cnames([('a.edu', 5, 1, 60, 'b.edu'), ('b.edu', 5, 1, 60, 'a.edu')], 1, 'a.edu')
+
     def test_parse_address_a(self):
         '''Parse IPv4 address'''
         assert parse_address_a(4, b'\xae\x81\x19\xaa') == '174.129.25.170'
@@ -160,5 +399,649 @@ class TestResolver:
         assert parse_address_aaaa(16, b' \x01I\x98\x00\x0c\x10#\x00\x00\x00\x00\x00\x00\x00\x04\xc0') == '2001:4998:c:1023:0:0:0:4'
 
 
+    def test_cache_ttl(self):
+        '''Cache answers until their TTL runs out'''
+        cache_put(1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=1000)
+        assert cache_get(1, ['Luther', 'EDU'], now=1100) == (0, [('luther.edu', 200, '174.129.25.170')])
+        assert cache_get(28, ['luther', 'edu'], now=1100) is None
+        assert cache_get(1, ['luther', 'edu'], now=1300) is None
+        assert cache_get(1, ['luther', 'edu'], now=1100) is None
+        assert resolver.CACHE_STATS['hits'] == 1
+        assert resolver.CACHE_STATS['misses'] == 3
+
+    def test_cache_negative(self):
+        '''Cache empty answers with their response code, for NEGATIVE_TTL or the TTL given'''
+        cache_put(1, ['nowhere', 'luther', 'edu'], [], now=1000)
+        assert cache_get(1, ['nowhere', 'luther', 'edu'], now=1000 + resolver.NEGATIVE_TTL - 1) == (0, [])
+        assert cache_get(1, ['nowhere', 'luther', 'edu'], now=1000 + resolver.NEGATIVE_TTL) is None
+        cache_put(1, ['gone', 'luther', 'edu'], [], resolver.RCODE_NXDOMAIN, 60, now=1000)
+        assert cache_get(1, ['gone', 'luther', 'edu'], now=1059) == (resolver.RCODE_NXDOMAIN, [])
+        assert cache_get(1, ['gone', 'luther', 'edu'], now=1060) is None
+
+    def test_negative_answer_ttl(self):
+        '''Take the TTL of a negative answer from its SOA record'''
+        soa = encode_name('ns.luther.edu') + encode_name('admin.luther.edu') + bytes(16) + (60).to_bytes(4, 'big')
+        query = format_query(1, ['gone', 'luther', 'edu'])
+        message = parse_message(build_response(query, authority=[('luther.edu', 6, 3600, soa)], rcode=3))
+        assert resolver.negative_answer_ttl(message) == 60
+        message = parse_message(build_response(query, authority=[('luther.edu', 6, 30, soa)], rcode=3))
+        assert resolver.negative_answer_ttl(message) == 30
+        assert resolver.negative_answer_ttl(parse_message(build_response(query, rcode=3))) == resolver.NEGATIVE_TTL
+
+    def test_cache_lru(self, monkeypatch):
+        '''Evict the least recently used entry when the cache is full'''
+        monkeypatch.setattr(resolver, 'CACHE_SIZE', 2)
+        cache_put(1, ['a', 'edu'], [('a.edu', 300, '10.0.0.1')], now=1000)
+        cache_put(1, ['b', 'edu'], [('b.edu', 300, '10.0.0.2')], now=1000)
+        assert cache_get(1, ['a', 'edu'], now=1000) is not None
+        cache_put(1, ['c', 'edu'], [('c.edu', 300, '10.0.0.3')], now=1000)
+        assert cache_get(1, ['b', 'edu'], now=1000) is None
+        assert cache_get(1, ['a', 'edu'], now=1000) is not None
+        assert resolver.CACHE_STATS['evictions'] == 1
+
+    def test_cache_stale(self, monkeypatch):
+        '''Keep expired answers for STALE_TTL seconds, for serve-stale only'''
+        monkeypatch.setattr(resolver, 'STALE_TTL', 3600)
+        cache_put(1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=1000)
+        assert cache_get_stale(1, ['luther', 'edu'], now=1100) is None
+        assert cache_get(1, ['luther', 'edu'], now=1300) is None
+        assert cache_get_stale(1, ['luther', 'edu'], now=1300) == (0, [('luther.edu', resolver.STALE_ANSWER_TTL, '174.129.25.170')])
+        assert cache_get(1, ['luther', 'edu'], now=1000 + 300 + 3600) is None
+        assert cache_get_stale(1, ['luther', 'edu'], now=1300) is None
+
+    def test_prefetch_due(self):
+        '''Prefetch entries hit often and close to expiry'''
+        cache_put(1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=1000)
+        for _ in range(resolver.PREFETCH_HITS):
+            assert not prefetch_due(1, ['luther', 'edu'], now=1100)
+            cache_get(1, ['luther', 'edu'], now=1100)
+        assert not prefetch_due(1, ['luther', 'edu'], now=1100)
+        assert prefetch_due(1, ['luther', 'edu'], now=1000 + 300 * (1 - resolver.PREFETCH_RATIO))
+        assert not prefetch_due(28, ['luther', 'edu'], now=1290)
+
+    def test_lookup_cached(self, monkeypatch):
+        '''Send a query only on a cache miss'''
+        sent = []
+
+        def fake_send_request(q_message, q_server, timeout=None):
+            sent.append(q_server)
+            return b'\xc7D\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01' + \
+                   b'\x00\x01\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04\xae\x81\x19\xaa'
+
+        monkeypatch.setattr(resolver, 'send_request', fake_send_request)
+        assert lookup(1, ['luther', 'edu'], '1.1.1.1') == ([('luther.edu', 300, '174.129.25.170')], '1.1.1.1')
+        assert lookup(1, ['luther', 'edu'], '1.1.1.1') == ([('luther.edu', 300, '174.129.25.170')], 'cache')
+        assert sent == ['1.1.1.1']
+
+
+    def test_disk_cache(self, tmp_path):
+        '''Share answers with absolute expiry between connections'''
+        filename = str(tmp_path / 'cache.db')
+        writer = open_cache_file(filename)
+        reader = open_cache_file(filename)
+        disk_cache_put(writer, 1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=1000)
+        disk_cache_put(writer, 1, ['nowhere', 'edu'], [], resolver.RCODE_NXDOMAIN, now=1000)
+        assert disk_cache_get(reader, 1, ['LUTHER', 'edu'], now=1250) == (0, [('luther.edu', 50, '174.129.25.170')])
+        assert disk_cache_get(reader, 1, ['nowhere', 'edu'], now=1250) == (resolver.RCODE_NXDOMAIN, [])
+        assert disk_cache_get(reader, 28, ['luther', 'edu'], now=1250) is None
+        assert disk_cache_get(reader, 1, ['luther', 'edu'], now=1300) is None
+        disk_cache_put(writer, 1, ['yahoo', 'com'], [('yahoo.com', 5, '98.137.246.7')], now=1400)
+        assert reader.execute('SELECT COUNT(*) FROM answers').fetchone()[0] == 1
+        writer.close()
+        reader.close()
+
+
+    def test_resolve_bulk_spoofed(self, monkeypatch):
+        '''Ignore responses with a wrong transaction id or question'''
+        def spoof(request):
+            return answer_a(bytes([request[0] ^ 1]) + request[1:]) if b'\x05wrong' in request else \
+                   answer_a(request[:12] + request[12:].replace(b'\x05right', b'\x05wrong'))
+
+        port, stop = start_udp_server(spoof)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.2)
+        monkeypatch.setattr(resolver, 'ATTEMPTS', 1)
+
+        async def collect():
+            return [result async for result in resolve_bulk(['wrong.edu', 'right.edu'], 'A', '127.0.0.1', n_sockets=1)]
+
+        try:
+            results = asyncio.run(collect())
+        finally:
+            stop()
+        assert sorted(results) == [('right.edu', [], 'timed out'), ('wrong.edu', [], 'timed out')]
+
+    def test_resolve_bulk(self, monkeypatch):
+        '''Resolve many names concurrently over a small socket pool'''
+        port, stop = start_udp_server(lambda request: None if b'\x04slow' in request else answer_a(request))
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.2)
+        monkeypatch.setattr(resolver, 'ATTEMPTS', 1)
+        names = ['host{}.edu\n'.format(i) for i in range(300)] + ['\n', 'slow.edu\n']
+
+        async def collect():
+            return [result async for result in resolve_bulk(names, 'A', '127.0.0.1', concurrency=50, n_sockets=2)]
+
+        try:
+            results = asyncio.run(collect())
+        finally:
+            stop()
+        assert len(results) == 301
+        assert ('host7.edu', [('host7.edu', 300, '127.0.0.1')], None) in results
+        assert ('slow.edu', [], 'timed out') in results
+        assert resolver.CACHE_STATS['misses'] == 301
+
+    def test_resolve_bulk_streaming(self, monkeypatch):
+        '''Yield results while the input is still waiting for its next line'''
+        port, stop = start_udp_server(answer_a)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        answered = threading.Event()
+
+        def slow_input(first: str, second: str):
+            yield first + '\n'
+            assert answered.wait(2)
+            yield second + '\n'
+
+        async def collect(results):
+            collected = []
+            async for result in results:
+                collected.append(result[0])
+                answered.set()
+            return collected
+
+        try:
+            assert asyncio.run(collect(resolve_bulk(slow_input('luther.edu', 'www.luther.edu'), 'A', '127.0.0.1'))) == \
+                ['luther.edu', 'www.luther.edu']
+            answered.clear()
+            assert asyncio.run(collect(resolve_reverse(slow_input('192.0.2.1', '192.0.2.2'), '127.0.0.1'))) == \
+                ['192.0.2.1', '192.0.2.2']
+        finally:
+            stop()
+
+
+    def test_rank_servers(self):
+        '''Prefer healthy servers with the lowest smoothed RTT'''
+        record_rtt('8.8.8.8', 0.080)
+        record_rtt('1.1.1.1', 0.010)
+        record_rtt('1.1.1.1', 0.018)
+        assert resolver.SERVER_STATS['1.1.1.1']['srtt'] == pytest.approx(0.011)
+        assert rank_servers(['8.8.8.8', '1.1.1.1', '9.9.9.9']) == ['9.9.9.9', '1.1.1.1', '8.8.8.8']
+        for _ in range(resolver.FAILURE_LIMIT):
+            record_failure('1.1.1.1', now=1000)
+        assert rank_servers(['8.8.8.8', '1.1.1.1'], now=1000) == ['8.8.8.8', '1.1.1.1']
+        assert rank_servers(['8.8.8.8', '1.1.1.1'], now=1000 + resolver.HOLDDOWN) == ['8.8.8.8', '1.1.1.1']
+        assert rank_servers(['8.8.8.8', '1.1.1.1'], now=1000 + 10 * resolver.SCORE_HALF_LIFE) == ['1.1.1.1', '8.8.8.8']
+
+    def test_server_score(self):
+        '''Errors add a penalty to the score that fades with time'''
+        record_rtt('1.1.1.1', 0.010, now=0)
+        assert server_score('1.1.1.1', now=0) == pytest.approx(0.010)
+        record_failure('1.1.1.1', now=0)
+        assert server_score('1.1.1.1', now=0) == pytest.approx(0.010 + resolver.ERROR_PENALTY * resolver.ERROR_ALPHA)
+        assert server_score('1.1.1.1', now=resolver.SCORE_HALF_LIFE) == pytest.approx(
+            0.010 + resolver.ERROR_PENALTY * resolver.ERROR_ALPHA / 2)
+        record_rtt('1.1.1.1', 0.010, now=resolver.SCORE_HALF_LIFE)
+        assert server_score('1.1.1.1', now=resolver.SCORE_HALF_LIFE) == pytest.approx(
+            0.010 + resolver.ERROR_PENALTY * resolver.ERROR_ALPHA / 2 * (1 - resolver.ERROR_ALPHA))
+        assert server_score('9.9.9.9') == 0.0
+
+    def test_query_servers_backoff(self, monkeypatch):
+        '''Retry with a growing timeout, failing over to the next server'''
+        tries = []
+
+        def fake_send_request(q_message, q_server, timeout=None):
+            tries.append((q_server, timeout))
+            raise resolver.SocketTimeout('timed out')
+
+        monkeypatch.setattr(resolver, 'send_request', fake_send_request)
+        with pytest.raises(OSError):
+            query_servers(format_query(1, ['luther', 'edu']), ['1.1.1.1', '8.8.8.8'])
+        assert tries == [('1.1.1.1', 1.0), ('8.8.8.8', 2.0), ('1.1.1.1', 4.0), ('8.8.8.8', 5.0)]
+        assert resolver.SERVER_STATS['1.1.1.1']['failures'] == 2
+
+    def test_query_servers_failover(self, monkeypatch):
+        '''Fail over from a silent server to a live one'''
+        port, stop_live = start_udp_server(answer_a, host='127.0.0.2')
+        _, stop_silent = start_udp_server(lambda request: None, port=port)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.05)
+        try:
+            response, server = query_servers(format_query(1, ['luther', 'edu']), ['127.0.0.1', '127.0.0.2'])
+        finally:
+            stop_live()
+            stop_silent()
+        assert server == '127.0.0.2'
+        assert parse_response(response) == [('luther.edu', 300, '127.0.0.1')]
+        assert resolver.SERVER_STATS['127.0.0.1']['failures'] == 1
+        assert resolver.SERVER_STATS['127.0.0.2']['srtt'] is not None
+
+    def test_query_servers_race(self, monkeypatch):
+        '''Race a silent and a live server, taking the first answer in a single attempt'''
+        port, stop_live = start_udp_server(answer_a, host='127.0.0.2')
+        _, stop_silent = start_udp_server(lambda request: None, port=port)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 5)
+        resolver.record_failure('127.0.0.1')
+        try:
+            response, server = query_servers(format_query(1, ['luther', 'edu']), ['127.0.0.1', '127.0.0.2'], race=2)
+        finally:
+            stop_live()
+            stop_silent()
+        assert server == '127.0.0.2'
+        assert parse_response(response) == [('luther.edu', 300, '127.0.0.1')]
+        assert resolver.SERVER_STATS['127.0.0.1']['failures'] == 1
+        assert resolver.SERVER_STATS['127.0.0.1']['srtt'] == resolver.BACKOFF * resolver.SERVER_STATS['127.0.0.2']['srtt']
+        assert resolver.rank_servers(['127.0.0.1', '127.0.0.2']) == ['127.0.0.2', '127.0.0.1']
+
+    def test_iterative_lookup(self, monkeypatch):
+        '''Follow referrals from a stand-in root to the authoritative server, then start from the cached zone'''
+        asked = []
+
+        def server(address, handler, port=0):
+            def serve(request):
+                asked.append(address)
+                assert request[2] & 0x01 == 0
+                return handler(request, parse_message(request)['questions'][0][0])
+            return start_udp_server(serve, host=address, port=port)
+
+        def root(request, name):
+            return build_response(request, authority=[('edu', 2, 3600, encode_name('a.edu-servers.net')),
+                                                      ('edu', 2, 3600, encode_name('b.edu-servers.net'))],
+                                  additional=[('a.edu-servers.net', 1, 3600, b'\x7f\x00\x00\x02')])
+
+        def edu(request, name):
+            return build_response(request, authority=[('luther.edu', 2, 3600, encode_name('ns.luther.edu'))],
+                                  additional=[('ns.luther.edu', 1, 3600, b'\x7f\x00\x00\x03'),
+                                              ('www.luther.edu', 1, 3600, b'\x7f\x00\x00\x04')])
+
+        def luther(request, name):
+            if name == 'www.luther.edu':
+                return build_response(request, answers=[('www.luther.edu', 5, 600, encode_name('web.luther.edu')),
+                                                        ('web.luther.edu', 1, 300, b'\x0a\x00\x00\x01')])
+            if name == 'mail.luther.edu':
+                return build_response(request, answers=[('mail.luther.edu', 1, 300, b'\x0a\x00\x00\x02')])
+            return build_response(request, rcode=3)
+
+        port, stop_root = server('127.0.0.1', root)
+        stops = [stop_root, server('127.0.0.2', edu, port)[1], server('127.0.0.3', luther, port)[1]]
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'ROOT_HINTS', ['127.0.0.1'])
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.2)
+        try:
+            assert iterative_lookup(1, ['www', 'luther', 'edu']) == [('web.luther.edu', 300, '10.0.0.1')]
+            assert asked == ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+            assert resolver.DELEGATIONS['luther.edu'][1] == ['ns.luther.edu']
+            assert resolver.GLUE['ns.luther.edu'][1] == ['127.0.0.3']
+            assert 'www.luther.edu' not in resolver.GLUE
+            assert 'b.edu-servers.net' not in resolver.GLUE
+            asked.clear()
+            assert iterative_lookup(1, ['mail', 'luther', 'edu']) == [('mail.luther.edu', 300, '10.0.0.2')]
+            assert iterative_lookup(1, ['missing', 'luther', 'edu']) == []
+            assert iterative_lookup(1, ['www', 'luther', 'edu']) == [('web.luther.edu', 300, '10.0.0.1')]
+            assert asked == ['127.0.0.3', '127.0.0.3']
+        finally:
+            for stop in stops:
+                stop()
+
+    def test_iterative_lame(self, monkeypatch):
+        '''Skip a lame server and a name server whose address cannot be found, and keep the answers in the cache file'''
+        def root(request, name):
+            if name == 'ns.broken.example':
+                return None
+            if name == 'ns.ok.example':
+                return build_response(request, answers=[(name, 1, 300, b'\x7f\x00\x00\x03')])
+            if name.endswith('.org'):
+                return build_response(request, authority=[('org', 2, 3600, encode_name('ns.broken.example')),
+                                                          ('org', 2, 3600, encode_name('ns.ok.example'))])
+            return build_response(request, authority=[('edu', 2, 3600, encode_name('a.edu-servers.net')),
+                                                      ('edu', 2, 3600, encode_name('b.edu-servers.net'))],
+                                  additional=[('a.edu-servers.net', 1, 3600, b'\x7f\x00\x00\x02'),
+                                              ('b.edu-servers.net', 1, 3600, b'\x7f\x00\x00\x03')])
+
+        def lame(request):
+            return build_response(request, authority=[('', 2, 3600, encode_name('a.root-servers.net'))])
+
+        def authoritative(request):
+            return build_response(request, answers=[(parse_message(request)['questions'][0][0], 1, 300, b'\x0a\x00\x00\x01')])
+
+        port, stop_root = start_udp_server(lambda request: root(request, parse_message(request)['questions'][0][0]))
+        stops = [stop_root, start_udp_server(lame, '127.0.0.2', port)[1], start_udp_server(authoritative, '127.0.0.3', port)[1]]
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'ROOT_HINTS', ['127.0.0.1'])
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.2)
+        monkeypatch.setattr(resolver, 'ATTEMPTS', 1)
+        monkeypatch.setattr(resolver, 'CACHE_DB', open_cache_file(':memory:'))
+        try:
+            assert iterative_lookup(1, ['www', 'luther', 'edu']) == [('www.luther.edu', 300, '10.0.0.1')]
+            assert resolver.SERVER_STATS['127.0.0.2']['failures'] == 1
+            assert iterative_lookup(1, ['www', 'luther', 'org']) == [('www.luther.org', 300, '10.0.0.1')]
+            assert resolver.GLUE['ns.ok.example'][1] == ['127.0.0.3']
+        finally:
+            for stop in stops:
+                stop()
+        assert disk_cache_get(resolver.CACHE_DB, 1, ['www', 'luther', 'edu']) == (0, [('www.luther.edu', 300, '10.0.0.1')])
+
+    def test_tcp_fallback(self, monkeypatch):
+        '''Retry truncated responses over TCP, reusing the connection'''
+        def truncated(request):
+            response = bytearray(answer_a(request)[:request.index(b'\x00', 12) + 5])
+            response[2] |= 0x02
+            response[7] = 0
+            return bytes(response)
+
+        port, stop_udp = start_udp_server(truncated)
+        _, accepted, stop_tcp = start_tcp_server(lambda request: answer_a(request, b'\x0a\x00\x00\x09'), port=port)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        try:
+            assert lookup(1, ['luther', 'edu'], '127.0.0.1', failover=False) == \
+                ([('luther.edu', 300, '10.0.0.9')], '127.0.0.1')
+            q_message = format_query(1, ['www', 'luther', 'edu'])
+            assert parse_response(send_request_tcp(q_message, '127.0.0.1')) == [('www.luther.edu', 300, '10.0.0.9')]
+            assert len(accepted) == 1
+            resolver.TCP_POOL['127.0.0.1'][0].shutdown(SHUT_RDWR)
+            assert parse_response(send_request_tcp(q_message, '127.0.0.1')) == [('www.luther.edu', 300, '10.0.0.9')]
+            assert len(accepted) == 2
+        finally:
+            stop_udp()
+            stop_tcp()
+
+    def test_edns_fallback(self, monkeypatch):
+        '''Ask again without the OPT record a server that answers it with FORMERR'''
+        requests = []
+
+        def no_edns(request):
+            requests.append(request)
+            return build_response(request, rcode=1) if request[11] else answer_a(request)
+
+        port, stop = start_udp_server(no_edns)
+        monkeypatch.setattr(resolver, 'PORT', port)
+
+        async def run():
+            pool = await resolver.open_pool(1)
+            try:
+                return await lookup_async(pool, 28, ['luther', 'edu'], '127.0.0.1', failover=False)
+            finally:
+                resolver.close_pool(pool)
+
+        try:
+            response, server = query_servers(encode_query(1, ['luther', 'edu'], payload_size=1232), ['127.0.0.1'])
+            assert parse_response(response) == [('luther.edu', 300, '127.0.0.1')]
+            assert [request[11] for request in requests] == [1, 0]
+            assert asyncio.run(run())[0] == resolver.RCODE_NOERROR
+            assert [request[11] for request in requests[2:]] == [1, 0]
+        finally:
+            stop()
+
+    def test_tcp_pool_threads(self, monkeypatch):
+        '''Share the TCP pool between threads, as the executor of the async path does'''
+        port, _, stop = start_tcp_server(lambda request: answer_a(request, b'\x0a\x00\x00\x09'))
+        monkeypatch.setattr(resolver, 'PORT', port)
+        q_message = format_query(1, ['luther', 'edu'])
+        results = []
+
+        def query():
+            for _ in range(20):
+                results.append(parse_response(send_request_tcp(q_message, '127.0.0.1')))
+
+        threads = [threading.Thread(target=query) for _ in range(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            stop()
+        assert results == [[('luther.edu', 300, '10.0.0.9')]] * 160
+        assert len(resolver.TCP_POOL['127.0.0.1']) <= resolver.TCP_POOL_SIZE
+
+    def test_format_response(self):
+        '''Build responses from answers, with a CNAME to the canonical name and truncation'''
+        query = format_query(1, ['www', 'luther', 'edu'], 0x4f42)
+        message = parse_message(format_response(query, ('www.luther.edu', 1, 1), [('web.luther.edu', 60, '10.0.0.1')]))
+        assert message['id'] == 0x4f42
+        assert message['flags'] & 0x8180 == 0x8180
+        assert message['answers'] == [('www.luther.edu', 5, 1, 60, 'web.luther.edu'), ('web.luther.edu', 1, 1, 60, '10.0.0.1')]
+        answers = [('luther.edu', 300, 'v=spf1 include:_spf.{}.luther.edu -all'.format(i)) for i in range(20)]
+        query = format_query(16, ['luther', 'edu'], 0x4f42)
+        message = parse_message(format_response(query, ('luther.edu', 16, 1), answers))
+        assert message['truncated'] and message['answers'] == []
+        assert not parse_message(format_response(query, ('luther.edu', 16, 1), answers, max_size=resolver.TCP_PAYLOAD))['truncated']
+        message = parse_message(format_response(query, ('luther.edu', 16, 1), answers, payload_size=4096))
+        assert not message['truncated'] and [a[4] for a in message['answers']] == [a[2] for a in answers]
+        assert message['additional'][0][1] == resolver.OPT_TYPE
+
+    def test_daemon(self, monkeypatch):
+        '''Answer queries from the cache, forwarding misses upstream'''
+        upstream = []
+        def answer(request):
+            upstream.append(request)
+            q_name = parse_message(request)['questions'][0][0]
+            if q_name == 'gone.luther.edu':
+                return build_response(request, rcode=3)
+            if q_name == '':
+                return build_response(request, [('', 2, 3600, encode_name('a.root-servers.net'))])
+            return answer_a(request)
+
+        port, stop = start_udp_server(answer)
+        monkeypatch.setattr(resolver, 'PORT', port)
+
+        def ask(daemon_port, query):
+            sckt = socket(AF_INET, SOCK_DGRAM)
+            sckt.settimeout(2)
+            with sckt:
+                sckt.sendto(query, ('127.0.0.1', daemon_port))
+                return sckt.recv(2048)
+
+        def ask_tcp(daemon_port, query):
+            sckt = socket(AF_INET, SOCK_STREAM)
+            sckt.settimeout(2)
+            with sckt:
+                sckt.connect(('127.0.0.1', daemon_port))
+                sckt.sendall(len(query).to_bytes(2, 'big') + query)
+                length = int.from_bytes(sckt.recv(2), 'big')
+                response = b''
+                while len(response) < length:
+                    response += sckt.recv(length - len(response))
+                return response
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            transport, protocol, pool = await open_daemon('127.0.0.1', 0, '127.0.0.1')
+            daemon_port = transport.get_extra_info('sockname')[1]
+            try:
+                query = format_query(1, ['luther', 'edu'], 0x1234, payload_size=1232)
+                first = await loop.run_in_executor(None, ask, daemon_port, query)
+                second = await loop.run_in_executor(None, ask, daemon_port, query)
+                bad = await loop.run_in_executor(None, ask, daemon_port, query[:20])
+                query = format_query(1, ['gone', 'luther', 'edu'])
+                gone = [await loop.run_in_executor(None, ask, daemon_port, query) for _ in range(2)]
+                query = format_query(1, ['luther', 'edu'], 0x5678)
+                tcp = await loop.run_in_executor(None, ask_tcp, daemon_port, query)
+                query = format_query(2, [])
+                root = [await loop.run_in_executor(None, ask, daemon_port, query) for _ in range(2)]
+            finally:
+                transport.close()
+                resolver.close_pool(pool)
+            return first, second, bad, gone, tcp, root, protocol.stats
+
+        try:
+            first, second, bad, gone, tcp, root, stats = asyncio.run(run())
+        finally:
+            stop()
+        assert len(upstream) == 3
+        assert parse_response(first) == parse_response(second) == [('luther.edu', 300, '127.0.0.1')]
+        assert first[:2] == second[:2] == b'\x12\x34'
+        assert resolver.get_rcode(bad) == resolver.RCODE_FORMERR
+        assert [resolver.get_rcode(response) for response in gone] == [resolver.RCODE_NXDOMAIN] * 2
+        assert tcp[:2] == b'\x56\x78' and parse_response(tcp) == parse_response(first)
+        for response in root:
+            message = parse_message(response)
+            assert message['questions'] == [('', 2, 1)]
+            assert [record[4] for record in message['answers']] == ['a.root-servers.net']
+        assert stats == {'queries': 8, 'cached': 5, 'forwarded': 3}
+
+    def test_daemon_bad_record(self, monkeypatch):
+        '''Answer SERVFAIL for records that cannot be encoded back, without caching them'''
+        upstream = []
+
+        def short_aaaa(request):
+            upstream.append(request)
+            return build_response(request, [('luther.edu', 28, 300, b'\x7f\x00\x00\x01')])
+
+        port, stop = start_udp_server(short_aaaa)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        query = format_query(28, ['luther', 'edu'])
+
+        async def run():
+            pool = await resolver.open_pool(1)
+            try:
+                return [await resolver.answer_upstream(pool, query, '127.0.0.1') for _ in range(2)]
+            finally:
+                resolver.close_pool(pool)
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            stop()
+        assert [resolver.get_rcode(response) for response in responses] == [resolver.RCODE_SERVFAIL] * 2
+        assert len(upstream) == 2 and resolver.answer_cached(query) is None
+        cache_put(28, ['luther', 'edu'], [('luther.edu', 300, '7f000001')])
+        assert resolver.get_rcode(resolver.answer_cached(query)) == resolver.RCODE_SERVFAIL
+
+    def test_lookup_async_coalesced(self, monkeypatch):
+        '''Send one upstream query for concurrent lookups of the same name'''
+        upstream = []
+
+        def slow(request):
+            upstream.append(request)
+            time.sleep(0.1)
+            return answer_a(request)
+
+        port, stop = start_udp_server(slow)
+        monkeypatch.setattr(resolver, 'PORT', port)
+
+        async def run():
+            pool = await resolver.open_pool(2)
+            try:
+                lookups = [lookup_async(pool, 1, ['luther', 'edu'], '127.0.0.1', failover=False) for _ in range(50)]
+                lookups.append(lookup_async(pool, 28, ['luther', 'edu'], '127.0.0.1', failover=False))
+                return await asyncio.gather(*lookups)
+            finally:
+                resolver.close_pool(pool)
+
+        try:
+            results = asyncio.run(run())
+        finally:
+            stop()
+        assert len(upstream) == 2
+        assert results[:50] == [(0, [('luther.edu', 300, '127.0.0.1')])] * 50
+        assert resolver.CACHE_STATS['coalesced'] == 49
+        assert resolver.IN_FLIGHT == {}
+
+    def test_lookup_serve_stale(self, monkeypatch):
+        '''Serve expired answers when the server does not answer'''
+        port, stop = start_udp_server(lambda request: None)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.05)
+        monkeypatch.setattr(resolver, 'ATTEMPTS', 1)
+        monkeypatch.setattr(resolver, 'STALE_TTL', 3600)
+        monkeypatch.setattr(resolver, 'STALE_TIMEOUT', 0.01)
+        cache_put(1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=time.time() - 400)
+
+        async def run():
+            pool = await resolver.open_pool(1)
+            try:
+                return await lookup_async(pool, 1, ['luther', 'edu'], '127.0.0.1', failover=False)
+            finally:
+                resolver.close_pool(pool)
+
+        try:
+            stale = [('luther.edu', resolver.STALE_ANSWER_TTL, '174.129.25.170')]
+            assert lookup(1, ['luther', 'edu'], '127.0.0.1', failover=False) == (stale, 'cache (stale)')
+            assert asyncio.run(run()) == (0, stale)
+            with pytest.raises(OSError):
+                lookup(28, ['luther', 'edu'], '127.0.0.1', failover=False)
+        finally:
+            stop()
+
+    def test_lookup_serve_stale_from_file(self, monkeypatch):
+        '''Serve expired answers kept in the cache file, giving the servers STALE_TIMEOUT seconds'''
+        port, stop = start_udp_server(lambda request: None)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 5)
+        monkeypatch.setattr(resolver, 'STALE_TTL', 3600)
+        monkeypatch.setattr(resolver, 'STALE_TIMEOUT', 0.2)
+        monkeypatch.setattr(resolver, 'CACHE_DB', open_cache_file(':memory:'))
+        disk_cache_put(resolver.CACHE_DB, 1, ['luther', 'edu'], [('luther.edu', 300, '174.129.25.170')], now=time.time() - 400)
+        disk_cache_put(resolver.CACHE_DB, 1, ['www', 'luther', 'edu'], [], now=time.time())
+        assert resolver.CACHE_DB.execute('SELECT COUNT(*) FROM answers').fetchone()[0] == 2
+        try:
+            start = time.monotonic()
+            assert lookup(1, ['luther', 'edu'], '127.0.0.1', failover=False) == \
+                ([('luther.edu', resolver.STALE_ANSWER_TTL, '174.129.25.170')], 'cache (stale)')
+            assert time.monotonic() - start < 1
+            assert resolver.CACHE_STATS['stale'] == 1
+        finally:
+            stop()
+
+    def test_lookup_async_prefetch(self, monkeypatch):
+        '''Refresh a hot entry in the background before it expires'''
+        upstream = []
+        port, stop = start_udp_server(lambda request: upstream.append(request) or answer_a(request))
+        monkeypatch.setattr(resolver, 'PORT', port)
+        cache_put(1, ['luther', 'edu'], [('luther.edu', 100, '10.0.0.1')], now=time.time() - 95)
+
+        async def run():
+            pool = await resolver.open_pool(1)
+            try:
+                results = [await lookup_async(pool, 1, ['luther', 'edu'], '127.0.0.1') for _ in range(resolver.PREFETCH_HITS)]
+                await asyncio.gather(*resolver.IN_FLIGHT.values())
+                return results
+            finally:
+                resolver.close_pool(pool)
+
+        try:
+            results = asyncio.run(run())
+        finally:
+            stop()
+        assert [answers[0][2] for _, answers in results] == ['10.0.0.1'] * resolver.PREFETCH_HITS
+        assert len(upstream) == 1
+        assert resolver.CACHE_STATS['prefetches'] == 1
+        assert cache_get(1, ['luther', 'edu']) == (0, [('luther.edu', 300, '127.0.0.1')])
+
+    def test_resolve_reverse(self, monkeypatch):
+        '''Look up addresses concurrently, yielding results in input order'''
+        upstream = []
+
+        def ptr(request):
+            name = parse_message(request)['questions'][0][0]
+            upstream.append(name)
+            if name == '1.2.0.192.in-addr.arpa' and upstream.count(name) == 1:
+                return None
+            if name.endswith('.ip6.arpa') or name.startswith('3.'):
+                return build_response(request, rcode=3)
+            return build_response(request, answers=[(name, 12, 300, encode_name('host-' + name.split('.')[0] + '.luther.edu'))])
+
+        port, stop = start_udp_server(ptr)
+        monkeypatch.setattr(resolver, 'PORT', port)
+        monkeypatch.setattr(resolver, 'TIMEOUT', 0.1)
+        addresses = ['192.0.2.1\n', '192.0.2.2\n', '\n', 'not an address\n', '192.0.2.3\n', '2001:db8::1\n', '192.0.2.2\n']
+
+        async def collect():
+            return [result async for result in resolve_reverse(addresses, '127.0.0.1', concurrency=3, n_sockets=1)]
+
+        try:
+            results = asyncio.run(collect())
+        finally:
+            stop()
+        assert [result[0] for result in results] == [a.strip() for a in addresses if a.strip()]
+        assert results[0] == ('192.0.2.1', ['host-1.luther.edu'], None)
+        assert results[1] == results[5] == ('192.0.2.2', ['host-2.luther.edu'], None)
+        assert results[2][2] is not None
+        assert results[3] == ('192.0.2.3', [], None)
+        assert results[4] == ('2001:db8::1', [], None)
+        assert upstream.count('2.2.0.192.in-addr.arpa') == 1
+
+
 if __name__ == '__main__':
     pytest.main(['test_resolver.py'])